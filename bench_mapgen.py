@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Benchmark of the level generation (make_map and place_objects): generates
+# seeded levels at several map sizes and room counts, and reports levels per
+# second, median and 99th percentile latency and peak memory. The results
+# can be written as JSON and compared against the JSON of an earlier run
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import lot
+
+DEFAULT_SIZES = '80x43,120x60,200x100'
+DEFAULT_ROOMS = '30,60'
+LEVEL_NUMBERS = 10  # Levels cycle through dungeon levels 1 to this
+MEMORY_LEVELS = 20  # Levels generated under tracemalloc for the peak memory
+
+
+def parse_sizes(text):
+    return [tuple(int(n) for n in size.split('x')) for size in text.split(',')]
+
+
+def parse_counts(text):
+    return [int(n) for n in text.split(',')]
+
+
+def setup(width, height, rooms):
+    # Make lot generate levels of the given size and number of rooms
+    lot.MAP_WIDTH = width
+    lot.MAP_HEIGHT = height
+    lot.MAX_ROOMS = rooms
+    lot.player = lot.Object(0, 0, b'@', 'player', lot.libtcod.white,
+                            blocks=True)
+
+
+def generate(seed, index):
+    # Generate the index-th level of the run with the given seed: levels 1 to
+    # LEVEL_NUMBERS of successive games
+    lot.game_seed = seed + index // LEVEL_NUMBERS
+    lot.dungeon_level = 1 + index % LEVEL_NUMBERS
+    lot.make_map()
+
+
+def measure(width, height, rooms, levels, seed):
+    # Benchmark one configuration, returning its results
+    setup(width, height, rooms)
+    generate(seed, 0)  # Warm up
+
+    times = np.empty(levels)
+    start = time.perf_counter()
+    for i in range(levels):
+        level_start = time.perf_counter()
+        generate(seed, i)
+        times[i] = time.perf_counter() - level_start
+    elapsed = time.perf_counter() - start
+
+    # Peak memory, separately since tracemalloc slows everything down
+    tracemalloc.start()
+    for i in range(min(levels, MEMORY_LEVELS)):
+        generate(seed, i)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'width': width, 'height': height, 'rooms': rooms,
+            'levels': levels,
+            'levels_per_second': levels / elapsed,
+            'p50_ms': float(np.percentile(times, 50)) * 1000,
+            'p99_ms': float(np.percentile(times, 99)) * 1000,
+            'peak_kib': peak / 1024}
+
+
+def config_key(result):
+    return (result['width'], result['height'], result['rooms'])
+
+
+def compare(results, baseline, tolerance):
+    # Print how the results compare to a baseline. Returns the number of
+    # configurations that got slower by more than tolerance (a fraction)
+    old_results = dict((config_key(r), r) for r in baseline['results'])
+    regressions = 0
+    for result in results:
+        old = old_results.get(config_key(result))
+        if old is None:
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1
+        slower = change > tolerance
+        regressions += slower
+        print('{}x{} {} rooms: p50 {:.3f} ms -> {:.3f} ms ({:+.1%}){}'.format(
+            result['width'], result['height'], result['rooms'],
+            old['p50_ms'], result['p50_ms'], change,
+            '  REGRESSION' if slower else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark level generation')
+    parser.add_argument('--levels', type=int, default=1000,
+                        help='levels generated per configuration '
+                             '(default: %(default)s)')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='map sizes, as WIDTHxHEIGHT separated by commas '
+                             '(default: %(default)s)')
+    parser.add_argument('--rooms', default=DEFAULT_ROOMS,
+                        help='maximum numbers of rooms, separated by commas '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the levels (default: %(default)s)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare against the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown of the median latency reported as a '
+                             'regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = []
+    print('{:>9} {:>5} {:>10} {:>9} {:>9} {:>10}'.format(
+        'size', 'rooms', 'levels/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    for (width, height) in parse_sizes(args.sizes):
+        for rooms in parse_counts(args.rooms):
+            result = measure(width, height, rooms, args.levels, args.seed)
+            results.append(result)
+            print('{:>9} {:>5} {:>10.1f} {:>9.3f} {:>9.3f} {:>10.1f}'.format(
+                '{}x{}'.format(width, height), rooms,
+                result['levels_per_second'], result['p50_ms'],
+                result['p99_ms'], result['peak_kib']))
+
+    if args.json:
+        report = {'python': platform.python_version(), 'seed': args.seed,
+                  'results': results}
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
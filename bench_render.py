@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Benchmark of the frame rendering (render_all): builds a seeded level with a
+# given density of monsters, then renders frames while the player wanders
+# around and the monsters take their turns, without a window and without a
+# frame rate limit. Reports the frame times, and the times of the FOV, map
+# lighting, object drawing and panel phases
+
+import argparse
+import collections
+import time
+
+import numpy as np
+
+import lot
+
+PHASES = [('fov', 'recompute_fov'), ('map', 'render_map'),
+          ('objects', 'render_objects'), ('panel', 'render_panel')]
+
+
+class ConsoleStandIn:
+  # Stands in for libtcodpy in lot, counting the calls to the console
+  # functions. Without a root console, these calls are only recorded and do
+  # nothing. Otherwise they go to libtcod, with the root console replaced by
+  # the given offscreen console
+
+    def __init__(self, module, root=None):
+        self.module = module
+        self.root = root
+        self.calls = collections.Counter()
+        self.consoles = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.module, name)
+        if name.startswith('console_') and callable(attribute):
+            attribute = self.recorder(name, attribute)
+            setattr(self, name, attribute)
+        return attribute
+
+    def recorder(self, name, function):
+        calls = self.calls
+        if self.root is None:
+            def record(*args):
+                calls[name] += 1
+                if name == 'console_new':
+                    self.consoles += 1
+                    return self.consoles
+                return 0
+        elif name == 'console_blit':
+            def record(src, x, y, w, h, dst, *args):
+                calls[name] += 1
+                return function(src, x, y, w, h, dst or self.root, *args)
+        else:
+            def record(*args):
+                calls[name] += 1
+                return function(*args)
+        return record
+
+
+class PhaseTimer:
+  # Replaces a function of lot with a wrapper recording how long each call
+  # takes, summed per frame
+
+    def __init__(self, name):
+        self.function = getattr(lot, name)
+        self.frame_time = 0.0
+        setattr(lot, name, self)
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.function(*args)
+        finally:
+            self.frame_time += time.perf_counter() - start
+
+    def take(self):
+        # The time spent in this frame, starting the next one
+        frame_time = self.frame_time
+        self.frame_time = 0.0
+        return frame_time
+
+
+def build_level(seed, level, density):
+    # Start a seeded game on the given dungeon level, adding monsters until
+    # there are density monsters per 100 floor tiles. The player cannot be
+    # hurt, so that the benchmark does not end with their death
+    lot.requested_seed = seed
+    lot.headless = True
+    lot.commands = lot.ScriptedCommands(lot.random_walk())
+    lot.new_game()
+    while lot.dungeon_level < level:
+        lot.change_level(lot.dungeon_level + 1)
+    lot.player.fighter.defense = 1000
+
+    floor = np.argwhere(~lot.map.blocked)
+    wanted = int(len(floor) * density / 100) - len(lot.registry.actors)
+    random = np.random.RandomState(seed)
+    for (x, y) in floor[random.permutation(len(floor))]:
+        if wanted <= 0:
+            break
+        if not lot.is_blocked(x, y):
+            fighter_component = lot.Fighter(hp=20, defense=0, power=4, xp=35,
+                                            death_function=lot.monster_death)
+            monster = lot.Object(int(x), int(y), 'o', 'orc',
+                                 lot.libtcod.desaturated_green, blocks=True,
+                                 fighter=fighter_component,
+                                 ai=lot.BasicMonster())
+            lot.add_object(monster)
+            lot.scheduler.schedule(monster)
+            wanted -= 1
+
+
+def play_turn():
+    # One frame of the game, without rendering
+    lot.handle_keys()
+    if lot.game_state == 'playing':
+        lot.take_monster_turns(lot.scheduler.pop_due())
+    lot.scheduler.tick()
+
+
+def summary(times):
+    times = np.asarray(times) * 1000
+    return (times.mean(), np.percentile(times, 50), np.percentile(times, 95),
+            np.percentile(times, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark frame rendering')
+    parser.add_argument('--frames', type=int, default=2000,
+                        help='frames rendered (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the game (default: %(default)s)')
+    parser.add_argument('--level', type=int, default=1,
+                        help='dungeon level rendered (default: %(default)s)')
+    parser.add_argument('--density', type=float, default=5,
+                        help='monsters per 100 floor tiles '
+                             '(default: %(default)s)')
+    parser.add_argument('--offscreen', action='store_true',
+                        help='draw into libtcod consoles instead of only '
+                             'recording the console calls')
+    args = parser.parse_args()
+
+    root = None
+    if args.offscreen:
+        root = lot.libtcod.console_new(lot.SCREEN_WIDTH, lot.SCREEN_HEIGHT)
+    standin = ConsoleStandIn(lot.libtcod, root)
+    lot.libtcod = standin
+    lot.con = lot.libtcod.console_new(lot.MAP_WIDTH, lot.MAP_HEIGHT)
+    lot.panel = lot.libtcod.console_new(lot.SCREEN_WIDTH, lot.PANEL_HEIGHT)
+
+    build_level(args.seed, args.level, args.density)
+    lot.mark_all_dirty()
+    timers = [(phase, PhaseTimer(name)) for (phase, name) in PHASES]
+    standin.calls.clear()
+
+    frame_times = []
+    phase_times = dict((phase, []) for (phase, name) in PHASES)
+    for frame in range(args.frames):
+        play_turn()
+        start = time.perf_counter()
+        lot.render_all()
+        frame_times.append(time.perf_counter() - start)
+        for (phase, timer) in timers:
+            phase_times[phase].append(timer.take())
+
+    print('{} frames, dungeon level {}, {} monsters, {} console calls per '
+          'frame'.format(args.frames, lot.dungeon_level,
+                         len(lot.registry.actors),
+                         sum(standin.calls.values()) // max(args.frames, 1)))
+    print('{:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'phase', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    rows = [(phase, phase_times[phase]) for (phase, name) in PHASES]
+    for (phase, times) in rows + [('frame', frame_times)]:
+        print('{:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            phase, *summary(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -25,9 +25,11 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import os
 import sys
 import ctypes
 import struct
+import time
 from ctypes import *
 
 if not hasattr(ctypes, "c_bool"):   # for Python < 2.6
@@ -914,9 +916,9 @@ def console_fill_foreground(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -935,9 +937,9 @@ def console_fill_background(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -952,7 +954,7 @@ def console_fill_background(con,r,g,b) :
 def console_fill_char(con,arr) :
     if (numpy_available and isinstance(arr, numpy.ndarray) ):
         #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
         carr = arr.ctypes.data_as(POINTER(c_int))
     else:
         #otherwise convert using the struct module
@@ -1543,6 +1545,49 @@ def map_get_width(map):
 def map_get_height(map):
     return _lib.TCOD_map_get_height(map)
 
+# bulk access to the map cells. This mirrors the map_t struct of fov_c.c,
+# where each cell is one byte of bit fields: transparent, walkable, fov
+class _CMap(Structure):
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('nbcells', c_int),
+              ('cells', POINTER(c_uint8)),
+              ]
+
+_MAP_TRANSPARENT = 1
+_MAP_WALKABLE = 2
+_MAP_FOV = 4
+
+def _map_cells(m):
+    # NumPy view of the cells of a map, shaped (height, width)
+    cmap = cast(c_void_p(m), POINTER(_CMap)).contents
+    return numpy.ctypeslib.as_array(cmap.cells, shape=(cmap.height, cmap.width))
+
+def map_set_properties_array(m, transparent, walkable):
+    # transparent and walkable are boolean arrays indexed [x, y]
+    if not numpy_available:
+        for x in range(len(transparent)):
+            for y in range(len(transparent[x])):
+                map_set_properties(m, x, y, transparent[x][y], walkable[x][y])
+        return
+    cells = _map_cells(m)
+    transparent = numpy.asarray(transparent, dtype=numpy.bool_).T
+    walkable = numpy.asarray(walkable, dtype=numpy.bool_).T
+    if transparent.shape != cells.shape or walkable.shape != cells.shape:
+        raise TypeError('Arrays must have the same size as the map.')
+    cells[...] = ((cells & _MAP_FOV) |
+                  transparent * numpy.uint8(_MAP_TRANSPARENT) |
+                  walkable * numpy.uint8(_MAP_WALKABLE))
+
+def map_get_properties_array(m):
+    # returns (transparent, walkable) as boolean arrays indexed [x, y]
+    cells = _map_cells(m).T
+    return ((cells & _MAP_TRANSPARENT) != 0, (cells & _MAP_WALKABLE) != 0)
+
+def map_get_fov_array(m):
+    # returns the last computed fov as a boolean array indexed [x, y]
+    return (_map_cells(m).T & _MAP_FOV) != 0
+
 ############################
 # pathfinding module
 ############################
@@ -1955,3 +2000,96 @@ def namegen_destroy() :
     _lib.TCOD_namegen_destroy()
 
 
+############################
+# native call counting
+############################
+# Opt-in instrumentation: once enabled, every call into the native library
+# is counted and timed per TCOD_* function. Enable it with
+# enable_call_counting() or by setting LIBTCOD_COUNT_CALLS=1 before the
+# import. call_report() returns the calls since its previous call (e.g. one
+# frame), call_totals() the calls since counting was enabled.
+
+class _CallCounter(object):
+    # stands in for _lib, handing out counting wrappers of its functions
+
+    def __init__(self, lib):
+        self._lib = lib
+        self._frame = {}
+        self._total = {}
+
+    def __getattr__(self, name):
+        function = getattr(self._lib, name)
+        if not callable(function):
+            return function
+        counter = self
+        clock = time.perf_counter
+
+        def counted(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                elapsed = clock() - start
+                stats = counter._frame.get(name)
+                if stats is None:
+                    counter._frame[name] = [1, elapsed]
+                else:
+                    stats[0] += 1
+                    stats[1] += elapsed
+        counted.__name__ = name
+        # cache the wrapper: later lookups don't reach __getattr__
+        object.__setattr__(self, name, counted)
+        return counted
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            # e.g. the Windows *_wrapper substitutions go to the library
+            setattr(self._lib, name, value)
+            self.__dict__.pop(name, None)
+
+    def report(self):
+        # folds the current counts into the totals and starts over
+        frame = self._frame
+        self._frame = {}
+        for (name, (calls, seconds)) in frame.items():
+            total = self._total.setdefault(name, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+        return _sorted_report(frame)
+
+def _sorted_report(counts):
+    # (function name, calls, seconds), most time spent first
+    return sorted(((name, calls, seconds)
+                   for (name, (calls, seconds)) in counts.items()),
+                  key=lambda entry: entry[2], reverse=True)
+
+def enable_call_counting():
+    global _lib
+    if not isinstance(_lib, _CallCounter):
+        _lib = _CallCounter(_lib)
+
+def disable_call_counting():
+    global _lib
+    if isinstance(_lib, _CallCounter):
+        _lib = _lib._lib
+
+def call_counting_enabled():
+    return isinstance(_lib, _CallCounter)
+
+def call_report():
+    # calls since the previous report, as (function name, calls, seconds)
+    # sorted by time spent; empty when counting is disabled
+    if not isinstance(_lib, _CallCounter):
+        return []
+    return _lib.report()
+
+def call_totals():
+    # calls since counting was enabled, up to the last call_report()
+    if not isinstance(_lib, _CallCounter):
+        return []
+    return _sorted_report(_lib._total)
+
+if os.environ.get('LIBTCOD_COUNT_CALLS'):
+    enable_call_counting()
@@ -4,9 +4,19 @@ try:
     import libtcodpy as libtcod
 except ImportError:
     raise ImportError('----- libtcod.py could not be loaded. -----')
+import argparse
+import collections
+import concurrent.futures
+import csv
+import heapq
 import math
+import os
+import shutil
+import tempfile
 import textwrap
-import shelve
+import struct
+import threading
+import time
 try:
     import numpy as np
 except ImportError:
@@ -47,6 +57,9 @@ FIREBALL_DAMAGE = 25
 FIREBALL_RADIUS = 3
 
 FOV_ALGO = 0  # default FOV algorithm
+# 'libtcod' computes the FOV with the native library, 'shadowcast' with the
+# built-in recursive shadowcasting, which does not need a libtcod map
+FOV_ENGINE = 'libtcod'
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
 SQUARED_TORCH_RADIUS = TORCH_RADIUS * TORCH_RADIUS
@@ -56,14 +69,40 @@ di = 0.0
 
 fov_recompute = None
 fov_noise = None
+fov_mask = None  # Tiles in the player's FOV, as a boolean array
+
+# Distance of every tile to the player, shared by all chasing monsters, and
+# the (map, x, y) it was computed for
+flow_field = None
+flow_origin = None
 fov_torchx = 0.0
 
+# What was last drawn to con and panel, so that only changes are redrawn
+con_background = None
+con_glyphs = {}
+panel_contents = None
+# Above this number of changed tiles, the whole map background is refilled
+# with one call instead of setting the tiles one by one. One fill costs
+# about as much as 15 to 20 single tiles (a Color and a ctypes call each), so
+# the torch flicker, which changes every lit tile, always takes the fill
+DIRTY_FILL_LIMIT = 16
+
 color_dark_wall = libtcod.Color(40, 40, 40)
 color_light_wall = libtcod.Color(60, 60, 60)
 color_dark_ground = libtcod.Color(25, 25, 25)
 color_light_ground = libtcod.Color(255, 230, 100)
 
+# The torch light is quantized to this many levels, whose colors are looked
+# up in light_palette (see update_light_palette)
+LIGHT_LEVELS = 256
+light_palette = None
+light_palette_colors = None  # The base colors light_palette was built from
+
 LIMIT_FPS = 20  # 20 frames-per-second limit
+# While nobody but the player has a turn coming, the screen is only drawn
+# this often, for the torch flicker, while input is still read every frame.
+# 0: no flicker, wait for input instead
+IDLE_FLICKER_FPS = 4
 
 # Number of frames to wait after moving/attacking
 PLAYER_SPEED = 2
@@ -79,6 +118,114 @@ MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
 
+# The eight directions a monster can step in
+STEP_DIRECTIONS = [(0, -1), (0, 1), (-1, 0), (1, 0),
+                   (-1, -1), (1, -1), (-1, 1), (1, 1)]
+# Distance field value of tiles that cannot be reached
+FLOW_UNREACHABLE = np.iinfo(np.int32).max
+
+# Player commands for moving, and their direction
+MOVE_COMMANDS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0),
+                 'right': (1, 0), 'up-left': (-1, -1), 'up-right': (1, -1),
+                 'down-left': (-1, 1), 'down-right': (1, 1)}
+# Keys for the movement commands (diagonals use the numpad keys)
+MOVE_KEYS = [(libtcod.KEY_UP, 'up'), (libtcod.KEY_DOWN, 'down'),
+             (libtcod.KEY_LEFT, 'left'), (libtcod.KEY_RIGHT, 'right'),
+             (libtcod.KEY_KP7, 'up-left'), (libtcod.KEY_KP9, 'up-right'),
+             (libtcod.KEY_KP1, 'down-left'), (libtcod.KEY_KP3, 'down-right')]
+
+# Without a window, input comes from a ScriptedCommands in "commands"
+headless = False
+commands = None
+HEADLESS_FRAMES = 10000  # Default length of a headless run
+
+# Levels the player left are kept: this many in memory, older ones in files
+# in a directory of their own under LEVEL_DIR (None: the system's temporary
+# directory)
+LEVEL_CACHE_SIZE = 4
+LEVEL_DIR = None
+levels = None
+
+# The next level down is generated ahead of time in a process pool (None:
+# generate levels when the player gets there)
+PREFETCH_LEVELS = True
+prefetcher = None
+# Each level is generated from a seed derived from the seed of the game, so
+# that it does not matter when or where it is generated
+game_seed = 0
+requested_seed = None  # Seed of new games (None: a random one)
+
+# Independent random number generators: map generation and spawning are
+# seeded for each level, the others for each game
+RNG_STREAMS = ('mapgen', 'spawn', 'combat', 'ai', 'fx')
+LEVEL_STREAMS = ('mapgen', 'spawn')
+rng = {}
+
+# Phases of a frame timed by the profiler, and the number of frames its
+# overlay (toggled with PROFILE_KEY) averages over
+PROFILE_TIMERS = ['handle_keys', 'ai', 'check_level_up', 'render_all',
+                  'render_objects', 'console_flush']
+PROFILE_WINDOW = 100
+PROFILE_KEY = 'p'
+NATIVE_CALLS_SHOWN = 15  # Functions listed by --count-calls
+
+# Save the game in the background every this many player turns (0: never)
+AUTOSAVE_TURNS = 20
+autosaver = None
+player_turns = 0  # Turns the player took
+last_autosave = 0  # Value of player_turns at the last autosave
+
+
+class ScriptedCommands:
+  # Input for headless runs. The script is a sequence of commands (see
+  # read_command; None stands for a frame without input), menu choices (an
+  # option index) and target tiles ((x, y) tuples). A menu whose choice is
+  # not next in the script gets default_choice; without one (None), the
+  # menu is dismissed by the next item of the script, like a key press
+  # would, and once the script has run out it gets the first option, so that
+  # menus asked again until answered (level up) end. A target request
+  # without a target is cancelled. Running out of script exits the game
+
+    def __init__(self, script, default_choice=0):
+        self.script = iter(script)
+        self.default_choice = default_choice
+        self.lookahead = []
+
+    def peek(self):
+        if not self.lookahead:
+            self.lookahead.append(next(self.script, StopIteration))
+        return self.lookahead[0]
+
+    def next_command(self):
+        item = self.peek()
+        if item is StopIteration:
+            return 'exit'
+        self.lookahead.pop()
+        if item is None or isinstance(item, str):
+            return item
+        return None  # A choice or target nothing asked for
+
+    def choose(self, count):
+        # The option picked in a menu with count options, or None
+        item = self.peek()
+        if type(item) == int and 0 <= item < count:
+            self.lookahead.pop()
+            return item
+        if self.default_choice is not None and self.default_choice < count:
+            return self.default_choice
+        if item is StopIteration:
+            return 0 if count else None
+        self.lookahead.pop()  # Dismisses the menu
+        return None
+
+    def target(self):
+        # The next target tile, or (None, None)
+        item = self.peek()
+        if isinstance(item, tuple):
+            self.lookahead.pop()
+            return item
+        return (None, None)
+
 
 class Rect:
   # A rectangle on the map
@@ -100,21 +247,357 @@ class Rect:
 
 
 class Tile:
-  # A tile of the map and its properties
+  # A tile of the map and its properties. This is only a view onto one cell
+  # of a TileMap, reads and writes go straight to the map's arrays
+    __slots__ = ('tiles', 'x', 'y')
+
+    def __init__(self, tiles, x, y):
+        self.tiles = tiles
+        self.x = x
+        self.y = y
+
+    @property
+    def blocked(self):
+        return bool(self.tiles.blocked[self.x, self.y])
+
+    @blocked.setter
+    def blocked(self, value):
+        self.tiles.blocked[self.x, self.y] = value
+
+    @property
+    def block_sight(self):
+        return bool(self.tiles.block_sight[self.x, self.y])
+
+    @block_sight.setter
+    def block_sight(self, value):
+        self.tiles.block_sight[self.x, self.y] = value
+
+    @property
+    def explored(self):
+        return bool(self.tiles.explored[self.x, self.y])
 
-    def __init__(self, blocked, block_sight=None):
-        self.blocked = blocked
-        self.explored = False
+    @explored.setter
+    def explored(self, value):
+        self.tiles.explored[self.x, self.y] = value
+
+
+class TileMap:
+  # The tiles of the map, stored as one boolean array per property and
+  # indexed [x, y]. map[x, y] returns a Tile view for single cells, while
+  # map.blocked, map.block_sight and map.explored can be used for bulk work
+
+    def __init__(self, width, height, blocked=True, block_sight=None):
+        self.width = width
+        self.height = height
+        self.blocked = np.full((width, height), blocked, dtype=np.bool_)
 
         # By default, a blocked tile also blocks sight
         if block_sight is None:
             block_sight = blocked
-        self.block_sight = block_sight
+        self.block_sight = np.full((width, height), block_sight,
+                                   dtype=np.bool_)
+        self.explored = np.zeros((width, height), dtype=np.bool_)
+
+    @property
+    def shape(self):
+        return (self.width, self.height)
+
+    def __getitem__(self, pos):
+        (x, y) = pos
+        return Tile(self, x, y)
+
+    def carve(self, boxes):
+        # Make a batch of (x1, y1, x2, y2) boxes passable at once. The box
+        # corners are marked on a difference grid, which is integrated into
+        # a coverage count, so the cost does not depend on the box sizes
+        boxes = np.asarray(boxes, dtype=np.intp).reshape(-1, 4)
+        if len(boxes) == 0:
+            return
+        (x1, y1, x2, y2) = boxes.T
+        cover = np.zeros((self.width + 1, self.height + 1), dtype=np.int32)
+        np.add.at(cover, (x1, y1), 1)
+        np.add.at(cover, (x2, y1), -1)
+        np.add.at(cover, (x1, y2), -1)
+        np.add.at(cover, (x2, y2), 1)
+        carved = cover.cumsum(axis=0).cumsum(axis=1)[:-1, :-1] > 0
+        self.blocked[carved] = False
+        self.block_sight[carved] = False
+
+
+class EntityRegistry:
+  # The objects on the map. objects keeps them in drawing order, and actors
+  # is a live set of the objects with an AI (a dict used as a set that keeps
+  # its order), so the scheduler only visits those. Call update() after
+  # changing the components of an object
+
+    def __init__(self, objects=()):
+        self.objects = []
+        self.actors = {}
+        for object in objects:
+            self.add(object)
+
+    def add(self, object):
+        self.objects.append(object)
+        self.file(object)
+
+    def remove(self, object):
+        self.objects.remove(object)
+        self.unfile(object)
+
+    def update(self, object):
+        self.unfile(object)
+        self.file(object)
+
+    def file(self, object):
+        # Put an object in the actors if it has an AI
+        if object.ai:
+            self.actors[object] = None
+
+    def unfile(self, object):
+        self.actors.pop(object, None)
+
+
+class ObjectIndex:
+  # Spatial index of the objects on the map. It keeps the objects standing on
+  # each tile and a grid counting the blocking objects on each tile, so both
+  # "what is at (x, y)" and "is (x, y) blocked" are O(1)
+
+    def __init__(self, width, height):
+        self.cells = {}  # (x, y) -> list of the objects on that tile
+        self.blockers = np.zeros((width, height), dtype=np.int16)
+
+    def add(self, object):
+        self.cells.setdefault((object.x, object.y), []).append(object)
+        if object.blocks:
+            self.blockers[object.x, object.y] += 1
+
+    def remove(self, object):
+        cell = self.cells[(object.x, object.y)]
+        cell.remove(object)
+        if not cell:
+            del self.cells[(object.x, object.y)]
+        if object.blocks:
+            self.blockers[object.x, object.y] -= 1
+
+    def move(self, object, x, y):
+        # Move an object to (x, y), keeping the index up to date
+        self.remove(object)
+        object.x = x
+        object.y = y
+        self.add(object)
+
+    def set_blocks(self, object, blocks):
+        # Change whether an object blocks its tile
+        if object.blocks != blocks:
+            self.blockers[object.x, object.y] += 1 if blocks else -1
+        object.blocks = blocks
+
+    def at(self, x, y):
+        # The objects on a tile, in the order they were put there
+        return self.cells.get((x, y), ())
+
+    def is_blocked(self, x, y):
+        # Whether a blocking object stands on a tile
+        return self.blockers[x, y] > 0
+
+    def fighters_in_radius(self, x, y, radius):
+        # All fighters within radius of (x, y), nearest first
+        fighters = []
+        for (dx, dy) in disk_stencil(radius * radius):
+            for object in self.cells.get((x + dx, y + dy), ()):
+                if object.fighter:
+                    fighters.append(object)
+        return fighters
+
+    def nearest_fighter(self, x, y, max_distance_squared, visible=None,
+                        exclude=None):
+        # The nearest fighter whose squared distance to (x, y) is at most
+        # max_distance_squared, optionally only on tiles set in the boolean
+        # array visible. Returns None if there is none
+        for (dx, dy) in disk_stencil(max_distance_squared):
+            cell = self.cells.get((x + dx, y + dy))
+            if cell and (visible is None or visible[x + dx, y + dy]):
+                for object in cell:
+                    if object.fighter and object is not exclude:
+                        return object
+        return None
+
+
+class Scheduler:
+  # Decides whose turn it is. Time is counted in frames, and every actor is
+  # kept in a heap by the frame on which it may act next, so each frame only
+  # the actors that are due get touched. Actors whose turns would do nothing
+  # can be parked instead, until woken up
+
+    def __init__(self):
+        self.time = 0
+        self.ready_at = {}  # actor -> frame on which it may act next
+        self.queue = []  # Heap of (frame, sequence, actor)
+        self.sequence = 0  # Keeps actors due on the same frame in order
+        self.parked = {}  # actor -> frame on which it would have acted next
+        self.waiting = set()  # Actors with a turn in the queue
+
+    def schedule(self, actor, delay=0):
+        # Let an actor act again after delay frames
+        time = self.time + delay
+        self.ready_at[actor] = time
+        self.waiting.add(actor)
+        heapq.heappush(self.queue, (time, self.sequence, actor))
+        self.sequence += 1
+
+    def is_ready(self, actor):
+        # Whether an actor may act on the current frame
+        return self.ready_at.get(actor, self.time) <= self.time
+
+    def pop_due(self):
+        # Take the actors due on the current frame off the queue
+        due = []
+        while self.queue and self.queue[0][0] <= self.time:
+            (time, sequence, actor) = heapq.heappop(self.queue)
+            if self.ready_at.get(actor) == time:  # Not rescheduled since
+                self.waiting.discard(actor)
+                due.append(actor)
+        return due
+
+    def park(self, actor, delay=0):
+        # Take an actor out of the turns until woken up
+        self.ready_at.pop(actor, None)  # Its queue entries are stale now
+        self.waiting.discard(actor)
+        self.parked[actor] = self.time + delay
+
+    def wake(self, condition):
+        # Schedule again the parked actors for which condition(actor) is
+        # true, no earlier than they would have acted
+        for actor in [actor for actor in self.parked if condition(actor)]:
+            self.schedule(actor, max(self.parked.pop(actor) - self.time, 0))
+
+    def has_turns(self, exclude=None):
+        # Whether any actor but exclude is waiting for a turn
+        return len(self.waiting) > (exclude in self.waiting)
+
+    def tick(self):
+        # Advance to the next frame
+        self.time += 1
+
+
+# Cache of disk_stencil results, by squared radius
+disk_stencils = {}
+
+
+def disk_stencil(radius_squared):
+    # The offsets (dx, dy) with dx * dx + dy * dy <= radius_squared, sorted
+    # from the center outwards
+    stencil = disk_stencils.get(radius_squared)
+    if stencil is None:
+        r = math.isqrt(radius_squared)
+        stencil = [(dx, dy) for dy in range(-r, r + 1)
+                   for dx in range(-r, r + 1)
+                   if dx * dx + dy * dy <= radius_squared]
+        stencil.sort(key=lambda d: d[0] * d[0] + d[1] * d[1])
+        disk_stencils[radius_squared] = stencil
+    return stencil
+
+
+class FrameTimer:
+  # Adds the time spent in a with block to a timer of a FrameProfiler
+    __slots__ = ('times', 'index', 'start')
+
+    def __init__(self, times, index):
+        self.times = times
+        self.index = index
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        self.times[self.index] += time.perf_counter() - self.start
+
+
+class FrameProfiler:
+  # Named timers for the phases of a frame. The timings of the last window
+  # frames are kept for the overlay in the panel, and every frame can also be
+  # written to a CSV file (in milliseconds)
+
+    def __init__(self, names, window=PROFILE_WINDOW):
+        self.names = list(names)
+        self.times = [0.0] * len(self.names)
+        self.timers = dict((name, FrameTimer(self.times, i))
+                           for (i, name) in enumerate(self.names))
+        self.history = collections.deque(maxlen=window)
+        self.frame = 0
+        self.frame_start = time.perf_counter()
+        self.overlay = False
+        self.csv_file = None
+        self.csv = None
+        self.native_calls = []  # libtcod calls of the last frame, if counted
+
+    def timer(self, name):
+        return self.timers[name]
+
+    def open_csv(self, filename):
+        # Write the timings of every frame to a CSV file from now on
+        self.csv_file = open(filename, 'w', newline='', buffering=1)
+        self.csv = csv.writer(self.csv_file)
+        self.csv.writerow(['frame'] + self.names + ['frame_total'])
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv = None
+
+    def end_frame(self):
+        # Record the timings of the frame that ends and start the next one.
+        # The total is the time since the previous frame ended
+        now = time.perf_counter()
+        timings = self.times + [now - self.frame_start]
+        self.frame_start = now
+        self.history.append(timings)
+        if self.csv is not None:
+            self.csv.writerow([self.frame] + ['{:.3f}'.format(t * 1000)
+                                              for t in timings])
+        self.frame += 1
+        for i in range(len(self.times)):
+            self.times[i] = 0.0
+        if libtcod.call_counting_enabled():
+            self.native_calls = libtcod.call_report()
+
+    def print_native_calls(self, count=NATIVE_CALLS_SHOWN):
+        # Print the libtcod functions that took the most time, per frame
+        frames = max(self.frame, 1)
+        print('{:<40} {:>12} {:>12}'.format('libtcod function', 'calls/frame',
+                                            'ms/frame'))
+        for (name, calls, seconds) in libtcod.call_totals()[:count]:
+            print('{:<40} {:>12.1f} {:>12.3f}'.format(
+                name, calls / frames, 1000 * seconds / frames))
+
+    def overlay_lines(self):
+        # The mean and maximum of each timer over the recent frames, two
+        # timers per line, and the slowest libtcod function if calls are
+        # counted
+        columns = []
+        for (i, name) in enumerate(self.names + ['frame']):
+            timings = [frame[i] for frame in self.history] or [0.0]
+            columns.append('{:<14}{:>6.1f}{:>6.1f}'.format(
+                name, 1000 * sum(timings) / len(timings), 1000 * max(timings)))
+        lines = ['ms, mean and max of the last {} frames'.format(
+            len(self.history))]
+        for i in range(0, len(columns), 2):
+            lines.append('  '.join(columns[i:i + 2]))
+        if self.native_calls:
+            # The libtcod function that took the most time in the last frame
+            (name, calls, seconds) = self.native_calls[0]
+            lines.append('libtcod: {} {}x {:.2f} ms'.format(
+                name, calls, 1000 * seconds))
+        return lines
 
 
 class Object:
   # This is a generic object: player, monster, item, ...
   # It is always represented by a character on screen
+    __slots__ = ('x', 'y', 'char', 'name', 'color', 'blocks', 'always_visible',
+                 'fighter', 'ai', 'item', 'speed', 'wait', 'level')
 
     def __init__(self, x, y, char, name, color, blocks=False,
                  always_visible=False, fighter=None, ai=None,
@@ -137,6 +620,7 @@ class Object:
             self.item.owner = self
         self.speed = speed
         self.wait = 0
+        self.level = None  # Experience level, only used for the player
 
     def distance_to(self, other):
         # Return the distance to another object
@@ -152,8 +636,7 @@ class Object:
         # Move by given amount
         try:
             if not is_blocked(self.x + dx, self.y + dy):
-                self.x += dx
-                self.y += dy
+                object_index.move(self, self.x + dx, self.y + dy)
         except:
             self.x = self.x
             self.y = self.y
@@ -172,15 +655,6 @@ class Object:
         dy = int(round(dy / distance))
         self.move(dx, dy)
 
-    def draw(self):
-        if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or
-           (self.always_visible and map[self.x, self.y].explored)):
-            # Set the color and draw the character
-            libtcod.console_put_char(con, self.x, self.y,
-                                     self.char, libtcod.BKGND_NONE)
-            libtcod.console_set_char_foreground(con, self.x,
-                                                self.y, self.color)
-
     def send_to_back(self):
         # Make this object be drawn first, so all other objects appear above
         # if they are in the same tile.
@@ -188,13 +662,11 @@ class Object:
         objects.remove(self)
         objects.insert(0, self)
 
-    def clear(self):
-        # Erease the character that represents this object
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
-
 
 class Item:
   # An item that can be picked up and used
+    __slots__ = ('use_function', 'owner')
+
     def __init__(self, use_function=None):
         self.use_function = use_function
 
@@ -205,7 +677,7 @@ class Item:
                      cannot pick up {}.'.format(self.owner.name), libtcod.red)
         else:
             inventory.append(self.owner)
-            objects.remove(self.owner)
+            remove_object(self.owner)
             message('You picked up {}!'.format(self.owner.name), libtcod.green)
 
     def use(self):
@@ -219,15 +691,18 @@ class Item:
 
     def drop(self):
         # Add to the map and remove from the player's inventory
-        objects.append(self.owner)
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
+        add_object(self.owner)
         message('You dropped a {}.'.format(self.owner.name), libtcod.yellow)
 
 
 class Fighter:
     # Combat reated properties and methods (monster, player, NPC)
+    __slots__ = ('max_hp', 'hp', 'defense', 'power', 'xp', 'death_function',
+                 'attack_speed', 'owner')
+
     def __init__(self, hp, defense, power, xp, death_function=None,
                  attack_speed=DEFAULT_ATTACK_SPEED):
         self.max_hp = hp
@@ -275,22 +750,112 @@ class Fighter:
 
 class BasicMonster:
     # AI for a basic monster
+    __slots__ = ('owner',)
+
     def take_turn(self):
-        # A basic monster that takes its turn.
-        # If you can see it, it can see you
-        monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
-            # Move towards player if far away
-            if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
-            # Close enough. Attack if the player is alive
-            elif player.fighter.hp > 0:
+        # A basic monster that takes its turn: a batch of one (see
+        # batch_monster_turns)
+        batch_monster_turns([self.owner])
+
+
+def batch_monster_turns(monsters):
+    # Take the turns of many BasicMonster actors at once. Who sees the
+    # player, who is close enough to attack and where everyone else steps is
+    # worked out for all of them together with NumPy; then the attacks and
+    # moves are applied in order. Returns whether each monster saw the player
+    if not monsters:
+        return []
+    xs = np.array([monster.x for monster in monsters])
+    ys = np.array([monster.y for monster in monsters])
+
+    # If you can see it, it can see you. Close enough (a distance below 2)
+    # attacks, everyone else moves
+    awake = fov_mask[xs, ys]
+    distance_squared = (xs - player.x) ** 2 + (ys - player.y) ** 2
+    attacking = awake & (distance_squared < 4)
+    moving = np.flatnonzero(awake & (distance_squared >= 4))
+
+    steps = np.zeros((len(monsters), 2), dtype=np.intp)
+    if len(moving):
+        steps[moving] = plan_steps(xs[moving], ys[moving])
+
+    # Resolve conflicts: of the monsters stepping onto the same tile, the
+    # first one gets it and the others wait
+    targets = (xs[moving] + steps[moving, 0]) * map.height + \
+        (ys[moving] + steps[moving, 1])
+    (_, first) = np.unique(targets, return_index=True)
+    stepping = np.zeros(len(monsters), dtype=np.bool_)
+    stepping[moving[first]] = True
+
+    for (i, monster) in enumerate(monsters):
+        if attacking[i]:
+            # Attack if the player is (still) alive
+            if player.fighter.hp > 0:
                 monster.fighter.attack(player)
+        elif stepping[i]:
+            monster.move(int(steps[i, 0]), int(steps[i, 1]))
+        elif awake[i]:
+            monster.wait = monster.speed  # Lost the tile to another monster
+    return awake
+
+
+def plan_steps(xs, ys):
+    # Next step (dx, dy) for monsters at (xs, ys) chasing the player: down
+    # the pursuit field to the lowest free neighbour, or straight towards
+    # the player like move_towards if there is none
+    field = pursuit_field()
+    directions = np.array(STEP_DIRECTIONS)
+    nx = xs[:, np.newaxis] + directions[:, 0]
+    ny = ys[:, np.newaxis] + directions[:, 1]
+    inside = (nx >= 0) & (nx < map.width) & (ny >= 0) & (ny < map.height)
+    nx = np.clip(nx, 0, map.width - 1)
+    ny = np.clip(ny, 0, map.height - 1)
+    free = inside & ~map.blocked[nx, ny] & (object_index.blockers[nx, ny] == 0)
+    distance = np.where(free, field[nx, ny], FLOW_UNREACHABLE)
+    best = distance.argmin(axis=1)  # The first of equals
+    downhill = distance[np.arange(len(xs)), best] < field[xs, ys]
+
+    dx = player.x - xs
+    dy = player.y - ys
+    length = np.sqrt(dx ** 2 + dy ** 2)
+    steps = np.stack([np.round(dx / length), np.round(dy / length)], axis=1)
+    steps = steps.astype(np.intp)
+    steps[downhill] = directions[best[downhill]]
+    return steps
+
+
+def take_monster_turns(actors):
+    # Let the actors that are due act: all BasicMonsters in one batch, any
+    # other AI one by one. BasicMonsters that cannot see the player do
+    # nothing until the player's FOV changes, so they are parked until then
+    batch = []
+    others = []
+    for actor in actors:
+        if actor not in registry.actors:  # Dead in the meantime (or the
+            continue                      # player, or on another level)
+        if type(actor.ai) is BasicMonster:
+            batch.append(actor)
+        else:
+            others.append(actor)
+
+    awake = batch_monster_turns(batch)
+    for actor in others:
+        actor.ai.take_turn()
+    for (actor, is_awake) in zip(batch, awake):
+        if is_awake:
+            end_turn(actor)
+        else:
+            scheduler.park(actor, actor.wait + 1)
+            actor.wait = 0
+    for actor in others:
+        end_turn(actor)
 
 
 class ConfusedMonster:
     # AI for a temporarily confused monster (reverts to
     # previous AI after a while).
+    __slots__ = ('old_ai', 'num_turns', 'owner')
+
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         self.old_ai = old_ai
         self.num_turns = num_turns
@@ -298,11 +863,12 @@ class ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0:  # Still confused
             # Move in a random direction
-            self.owner.move(libtcod.random_get_int(0, -1, 1),
-                            libtcod.random_get_int(0, -1, 1))
+            self.owner.move(libtcod.random_get_int(rng['ai'], -1, 1),
+                            libtcod.random_get_int(rng['ai'], -1, 1))
         else:  # Restore the previous AI (this one will be deleted because
                # it's not referenced anymore)
             self.owner.ai = self.old_ai
+            registry.update(self.owner)
             message('The {} is no longer confused!'.format(self.owner.name),
                     libtcod.red)
 
@@ -327,30 +893,20 @@ def monster_death(monster):
                                              str(monster.fighter.xp)))
     monster.char = b'%'
     monster.color = libtcod.dark_red
-    monster.blocks = False
+    object_index.set_blocks(monster, False)
     monster.fighter = None
     monster.ai = None
+    registry.update(monster)
     monster.name = 'remains of {}'.format(monster.name)
     monster.send_to_back()
 
 
 def closest_monster(max_range):
-    # Find the closest enemy up to a maximum range and in the player's FOV
-    closest_enemy = None
-    closest_dist = max_range + 1  # Start with (slightly more than) max. range
-
-    for object in objects:
-        if (
-            object.fighter and not
-            object == player and
-            libtcod.map_is_in_fov(fov_map, object.x, object.y)
-        ):
-            # Calculate the distance between this object and the player
-            dist = player.distance_to(object)
-            if dist < closest_dist:  # Its closer, so remember it
-                closest_enemy = object
-                closest_dist = dist
-    return closest_enemy
+    # Find the closest enemy up to a maximum range and in the player's FOV.
+    # Like a distance below max_range + 1, with integer squared distances
+    return object_index.nearest_fighter(player.x, player.y,
+                                        (max_range + 1) ** 2 - 1,
+                                        visible=fov_mask, exclude=player)
 
 
 def cast_heal():
@@ -387,10 +943,15 @@ def cast_confuse():
         return 'cancelled'
 
     # Replace the monster's AI with a "confused" one;
-    # after some turns it will restore the old AI
-    old_ai = monster.ai
-    monster.ai = ConfusedMonster(old_ai)
-    monster.ai.owner = monster  # Tell the new component who owns it
+    # after some turns it will restore the old AI. Confusing it again only
+    # makes it last longer, so there is never more than one old AI to save
+    if isinstance(monster.ai, ConfusedMonster):
+        monster.ai.num_turns = CONFUSE_NUM_TURNS
+    else:
+        old_ai = monster.ai
+        monster.ai = ConfusedMonster(old_ai)
+        monster.ai.owner = monster  # Tell the new component who owns it
+        registry.update(monster)
     message('The eyes of the {} look vacant, \
              as he starts to stumble around!'.format(monster.name),
             libtcod.light_green)
@@ -407,8 +968,9 @@ def cast_fireball():
              burning everything within {} tiles!'.format(FIREBALL_RADIUS),
             libtcod.orange)
 
-    for obj in objects:  # Damage every fighter in range, including the player
-        if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
+    # Damage every fighter in range, including the player
+    for obj in object_index.fighters_in_radius(x, y, FIREBALL_RADIUS):
+        if obj.fighter:
             message('The {} gets \
                     burned for {} hit points.'.format(obj.name,
                                                       FIREBALL_DAMAGE),
@@ -421,6 +983,13 @@ def target_tile(max_range=None):
   # (optionally in a range), or (None, None) if right-clicked
     global key
     global mouse
+    if headless:
+        (x, y) = commands.target()
+        if (x is not None and in_fov(x, y) and
+           (max_range is None or player.distance(x, y) <= max_range)):
+            return (x, y)
+        return (None, None)
+
     while True:
         # Render the screen. This erases the inventory and shows the names of
         # objects under the mouse.
@@ -434,7 +1003,7 @@ def target_tile(max_range=None):
         # print('{}:{}'.format(str(x), str(y)))
         # Accept the taret if the player clicked in FOV and in case a range is
         # specified, if it's in that range
-        if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and
+        if (mouse.lbutton_pressed and in_fov(x, y) and
            (max_range is None or player.distance(x, y) <= max_range)):
             return (x, y)
         if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
@@ -450,53 +1019,96 @@ def target_monster(max_range=None):
             return None
 
         # Return the first clicked monster, otherwise continue looping
-        for obj in objects:
-            if obj.x == x and obj.y == y and obj.fighter and obj != player:
+        for obj in object_index.at(x, y):
+            if obj.fighter and obj != player:
                 return obj
 
 
-def create_room(room):
-    global map
-    # Go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x, y].blocked = False
-            map[x, y].block_sight = False
+def room_box(room):
+    # The box of tiles inside the walls of a room
+    return (room.x1 + 1, room.y1 + 1, room.x2, room.y2)
+
 
+def h_tunnel_box(x1, x2, y):
+    # The box of tiles of a horizontal tunnel
+    return (min(x1, x2), y, max(x1, x2) + 1, y + 1)
 
-def create_h_tunnel(x1, x2, y):
-    # Horizontal tunnel
-    global map
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x, y].blocked = False
-        map[x, y].block_sight = False
 
+def v_tunnel_box(y1, y2, x):
+    # The box of tiles of a vertical tunnel
+    return (x, min(y1, y2), x + 1, max(y1, y2) + 1)
 
-def create_v_tunnel(y1, y2, x):
-    # Vertical tunnel
-    global map
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x, y].blocked = False
-        map[x, y].block_sight = False
+
+def compute_flow_field(walkable, x, y):
+    # Distance in steps (diagonal steps included) from (x, y) to every tile
+    # over the walkable ones, as an int32 array. A breadth-first search that
+    # grows the whole wavefront one step at a time with array operations
+    field = np.full(walkable.shape, FLOW_UNREACHABLE, dtype=np.int32)
+    frontier = np.zeros(walkable.shape, dtype=np.bool_)
+    frontier[x, y] = True
+    reached = frontier.copy()
+    distance = 0
+    while frontier.any():
+        field[frontier] = distance
+        # Grow the frontier by one tile in all eight directions
+        grown = frontier.copy()
+        grown[1:, :] |= frontier[:-1, :]
+        grown[:-1, :] |= frontier[1:, :]
+        spread = grown.copy()
+        spread[:, 1:] |= grown[:, :-1]
+        spread[:, :-1] |= grown[:, 1:]
+        frontier = spread & walkable & ~reached
+        reached |= frontier
+        distance += 1
+    return field
+
+
+def pursuit_field():
+    # The distance field toward the player. It is computed at most once per
+    # player move, however many monsters follow it
+    global flow_field, flow_origin
+    if flow_origin != (map, player.x, player.y):
+        flow_field = compute_flow_field(~map.blocked, player.x, player.y)
+        flow_origin = (map, player.x, player.y)
+    return flow_field
 
 
 def is_blocked(x, y):
     # First test the map tile
-    if map[x, y].blocked:
-        return true
+    if map.blocked[x, y]:
+        return True
 
     # Now check for any blocking object
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
+    return object_index.is_blocked(x, y)
+
+
+def add_object(object):
+    # Put an object on the map
+    registry.add(object)
+    object_index.add(object)
 
-    return False
+
+def remove_object(object):
+    # Take an object off the map
+    registry.remove(object)
+    object_index.remove(object)
+
+
+def index_objects():
+    # Build the registry and the spatial index for the objects on the
+    # current map
+    global objects, registry, object_index
+    registry = EntityRegistry(objects)
+    objects = registry.objects
+    object_index = ObjectIndex(map.width, map.height)
+    for object in objects:
+        object_index.add(object)
 
 
 def random_choice_index(chances):
 # Choose one option from list of chances, returning its index
     # The dice will land on some number between 1 and the sum of the chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+    dice = libtcod.random_get_int(rng['spawn'], 1, sum(chances))
 
     # Go through all chances, keeping the sum so far
     running_sum = 0
@@ -550,12 +1162,12 @@ def place_objects(room):
     item_chances['confuse'] = from_dungeon_level([[10, 2]])
 
     # Choose a random number of monsters
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+    num_monsters = libtcod.random_get_int(rng['spawn'], 0, max_monsters)
 
     for i in range(num_monsters):
         # Choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = libtcod.random_get_int(rng['spawn'], room.x1 + 1, room.x2 - 1)
+        y = libtcod.random_get_int(rng['spawn'], room.y1 + 1, room.y2 - 1)
 
         # Only place it if the tile is unblocked
         if not is_blocked(x, y):
@@ -583,15 +1195,17 @@ def place_objects(room):
                                  blocks=True, fighter=fighter_component,
                                  ai=ai_component)
 
-            objects.append(monster)
+            add_object(monster)
 
             # Choose random number of items
-            num_items = libtcod.random_get_int(0, 0, max_items)
+            num_items = libtcod.random_get_int(rng['spawn'], 0, max_items)
 
             for i in range(num_items):
                 # Choose random spot for this item
-                x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-                y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+                x = libtcod.random_get_int(rng['spawn'], room.x1 + 1,
+                                            room.x2 - 1)
+                y = libtcod.random_get_int(rng['spawn'], room.y1 + 1,
+                                            room.y2 - 1)
 
                 # Only place it if the tile is not blocked
                 if not is_blocked(x, y):
@@ -621,33 +1235,34 @@ def place_objects(room):
                                       libtcod.light_yellow,
                                       item=item_component)
 
-                    objects.append(item)
+                    add_object(item)
                     item.send_to_back()
                     item.always_visible = True
 
 
 def make_map():
-    global map, objects, stairs
+    global map, objects, registry, object_index, stairs, upstairs
+
+    seed_streams(level_seed(dungeon_level), LEVEL_STREAMS)
 
-    # The listof objects with just the player
-    objects = [player]
+    # The listof objects, the player is added once placed
+    registry = EntityRegistry()
+    objects = registry.objects
 
-    # Fill the map with unblocked tiles
-    map = np.zeros((MAP_WIDTH, MAP_HEIGHT), object)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            map[x, y] = Tile(True)
+    # Fill the map with blocked tiles
+    map = TileMap(MAP_WIDTH, MAP_HEIGHT)
+    object_index = ObjectIndex(MAP_WIDTH, MAP_HEIGHT)
 
     rooms = []
-    num_rooms = 0
+    boxes = []  # Rooms and tunnels to carve, as (x1, y1, x2, y2) boxes
 
     for r in range(MAX_ROOMS):
         # Random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         # Random position without going of the map boundaries
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng['mapgen'], 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng['mapgen'], 0, MAP_HEIGHT - h - 1)
 
         new_room = Rect(x, y, w, h)
 
@@ -658,12 +1273,10 @@ def make_map():
                 break
 
         if not failed:
-            create_room(new_room)
-            # add some contents to this room, such as monsters
-            place_objects(new_room)
+            boxes.append(room_box(new_room))
             (new_x, new_y) = new_room.center()
 
-            if num_rooms == 0:
+            if len(rooms) == 0:
                 # if this is the first room, the player starts here
                 player.x = new_x
                 player.y = new_y
@@ -672,55 +1285,236 @@ def make_map():
                 # connect it to the previous room with a tunnel
 
                 #center coordinated of previous room
-                (prev_x, prev_y) = rooms[num_rooms - 1].center()
+                (prev_x, prev_y) = rooms[-1].center()
 
                 # Draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng['mapgen'], 0, 1) == 1:
                     # first move horizontally, then vertical
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
+                    boxes.append(h_tunnel_box(prev_x, new_x, prev_y))
+                    boxes.append(v_tunnel_box(prev_y, new_y, new_x))
                 else:
                     # first move vertically, then horizontally
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
+                    boxes.append(v_tunnel_box(prev_y, new_y, prev_x))
+                    boxes.append(h_tunnel_box(prev_x, new_x, new_y))
 
             # Finally, append the new room to the list
             rooms.append(new_room)
-            num_rooms += 1
+
+    # Carve all rooms and tunnels in one pass
+    map.carve(boxes)
+    add_object(player)
+
+    # Add some contents to the rooms, such as monsters
+    for room in rooms:
+        place_objects(room)
 
     # Create stairs at the center of the last room
     stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white,
                     always_visible=True)
-    objects.append(stairs)
+    add_object(stairs)
+
+    # Below the first level, stairs back up where the player arrives
+    upstairs = None
+    if dungeon_level > 1:
+        upstairs = Object(player.x, player.y, '>', 'stairs up', libtcod.white,
+                          always_visible=True)
+        add_object(upstairs)
+        upstairs.send_to_back()
+
+    schedule_actors()
 
 
 def next_level():
-    # Advance to the next level
+    # Advance to the next level. Only going down to a new level rests the
+    # player, not going back down to one left before
     global dungeon_level
 
-    message('You take a moment to rest and recover your strength.',
-            libtcod.light_violet)
-    # Heal the player by 50 %
-    player.fighter.heal(int(round(player.fighter.max_hp / 2)))
+    if dungeon_level + 1 not in levels:
+        message('You take a moment to rest and recover your strength.',
+                libtcod.light_violet)
+        # Heal the player by 50 %
+        player.fighter.heal(int(round(player.fighter.max_hp / 2)))
+
+        message('After a rare moment of peace, you descend \
+                deeper into the heart of the dungeon...', libtcod.red)
+    else:
+        message('You go back down the stairs.', libtcod.light_violet)
+    change_level(dungeon_level + 1)
+
+
+def previous_level():
+    # Go back up to the previous level
+    message('You climb back up the stairs.', libtcod.light_violet)
+    change_level(dungeon_level - 1)
+
+
+def level_seed(number):
+    # The seed dungeon level number is generated from
+    return (game_seed + number * 0x9e3779b9) & 0xffffffff
+
+
+def stream_seed(seed, stream):
+    # The seed of an RNG stream, from the seed of a game or a level
+    return (seed + (RNG_STREAMS.index(stream) + 1) * 0x85ebca6b) & 0xffffffff
 
-    message('After a rare moment of peace, you descend \
-            deeper into the heart of the dungeon...', libtcod.red)
-    dungeon_level += 1
+
+def seed_streams(seed, streams):
+    # (Re)create the given RNG streams from a game or level seed
+    for stream in streams:
+        if stream in rng:
+            libtcod.random_delete(rng[stream])
+        rng[stream] = libtcod.random_new_from_seed(stream_seed(seed, stream))
+
+
+def game_streams():
+    return [stream for stream in RNG_STREAMS if stream not in LEVEL_STREAMS]
+
+
+def generate_level(seed, number):
+    # Generate dungeon level number of the game with the given seed, without
+    # touching the game being played (in a prefetcher process). Returns the
+    # index the player had in the objects and the level in the level format
+    global game_seed, dungeon_level, player
+    (game_seed, dungeon_level) = (seed, number)
+    player = Object(0, 0, b'@', 'player', libtcod.white, blocks=True)
     make_map()
+    player_index = objects.index(player)
+    remove_object(player)
+    return (player_index, encode_level(number,
+                                       (map, objects, stairs, upstairs)))
+
+
+def prefetch_next_level():
+    # Start generating the level below, unless it was visited before. If the
+    # prefetcher broke down, levels are generated when the player gets there
+    global prefetcher
+    if prefetcher is not None and dungeon_level + 1 not in levels:
+        if not prefetcher.request(game_seed, dungeon_level + 1):
+            prefetcher.shutdown()
+            prefetcher = None
+
+
+def change_level(number):
+    # Leave the current level for another one. A level visited before is
+    # restored as it was left, a new one is generated
+    global dungeon_level
+    going_down = number > dungeon_level
+
+    # Keep the current level, without the player
+    remove_object(player)
+    levels.store(dungeon_level, (map, objects, stairs, upstairs))
+
+    dungeon_level = number
+    level = levels.take(number)
+    player_index = None
+    if level is None and prefetcher is not None:
+        (level, player_index) = prefetcher.take(game_seed, number)
+    if level is None:
+        make_map()
+    else:
+        enter_level(level, going_down, player_index)
     initialize_fov()
+    prefetch_next_level()
+
+
+def enter_level(level, going_down, player_index=None):
+    # Make a level from the level cache or the prefetcher the current one.
+    # The player arrives at the stairs they came through, and is inserted in
+    # the objects at player_index (default: last)
+    global map, objects, stairs, upstairs
+    (map, objects, stairs, upstairs) = level
+    arrival = upstairs if going_down else stairs
+    player.x = arrival.x
+    player.y = arrival.y
+    if player_index is None:
+        player_index = len(objects)
+    objects.insert(player_index, player)
+    index_objects()
+    schedule_actors()
+
+
+# Transformations from the coordinates of the first octant to each of the
+# eight octants around the viewer, as (xx, xy, yx, yy)
+FOV_OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+
+def compute_fov(transparent, x, y, radius=0, light_walls=True):
+    # Recursive shadowcasting FOV. transparent is a boolean array indexed
+    # [x, y], the result a boolean array of the tiles seen from (x, y). A
+    # radius of 0 means unlimited; walls are only lit if light_walls is set
+    (width, height) = transparent.shape
+    if radius <= 0:
+        radius = width + height  # Farther than any tile, even diagonally
+    opaque = (~transparent).tolist()  # Lists are faster to index one by one
+    seen = np.zeros((width, height), dtype=np.bool_).tolist()
+    seen[x][y] = True
+    for octant in FOV_OCTANTS:
+        cast_light(opaque, seen, x, y, 1, 1.0, 0.0, radius, octant,
+                   light_walls)
+    return np.array(seen, dtype=np.bool_)
+
+
+def cast_light(opaque, seen, cx, cy, row, start, end, radius, octant,
+               light_walls):
+    # Scan one octant row by row from row outwards, between the slopes start
+    # and end. Each wall splits the scan and recurses for the part above it
+    if start < end:
+        return
+    (xx, xy, yx, yy) = octant
+    width = len(opaque)
+    height = len(opaque[0])
+    radius_squared = radius * radius
+    new_start = start
+    for j in range(row, radius + 1):
+        dy = -j
+        blocked = False
+        for dx in range(-j, 1):
+            # Slopes to the left and right edges of this tile
+            l_slope = (dx - 0.5) / (dy + 0.5)
+            r_slope = (dx + 0.5) / (dy - 0.5)
+            if start < r_slope:
+                continue
+            elif end > l_slope:
+                break
+
+            # Translate the octant coordinates to map coordinates. Tiles
+            # outside the map act as walls
+            x = cx + dx * xx + dy * xy
+            y = cy + dx * yx + dy * yy
+            inside = 0 <= x < width and 0 <= y < height
+            wall = not inside or opaque[x][y]
+            if (inside and dx * dx + dy * dy <= radius_squared and
+               (light_walls or not wall)):
+                seen[x][y] = True
+
+            if blocked:
+                if wall:
+                    # Still scanning a run of walls
+                    new_start = r_slope
+                else:
+                    # The wall run ended, continue with the next open tile
+                    blocked = False
+                    start = new_start
+            elif wall and j < radius:
+                # A wall starts, scan the part of the next row above it
+                blocked = True
+                cast_light(opaque, seen, cx, cy, j + 1, start, l_slope,
+                           radius, octant, light_walls)
+                new_start = r_slope
+        if blocked:
+            break
 
 
 def render_all():
 
-    global fov_map, color_dark_wall, color_light_wall
+    global color_dark_wall, color_light_wall
     global color_dark_ground, color_light_ground
-    global fov_recompute, fov_torchx
+    global fov_torchx
 
     if fov_recompute:
         #recompute FOV if needed (the player moved or something)
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS,
-                                FOV_LIGHT_WALLS, FOV_ALGO)
+        recompute_fov()
 
     #torch flickers (using noise generator)
     fov_torchx += 0.2
@@ -730,70 +1524,157 @@ def render_all():
     dy = libtcod.noise_get(fov_noise, tdx) * 1.5
     di = 0.2 * libtcod.noise_get(fov_noise, [fov_torchx])
 
-    # Iterate through rendering queue
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            visible = libtcod.map_is_in_fov(fov_map, x, y)
-            wall = map[x, y].block_sight  # check if tile is a wall
-            if not visible:
-                # if it's not visible right now, the player can only
-                # see it if it's explored
-                if map[x, y].explored:
-                    # It's out of the player's FOV
-                    if wall:
-                        libtcod.console_set_char_background(con, x, y,
-                                                            color_dark_wall,
-                                                            libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(con, x, y,
-                                                            color_dark_ground,
-                                                            libtcod.BKGND_SET)
-            else:
-            # It's visible
-                if wall:
-                    base = color_dark_wall
-                    light = color_light_wall
-                else:
-                    base = color_dark_ground
-                    light = color_light_ground
-
-                #Let the torch actually flicker
-                r = float(x - player.x + dx) * (x - player.x + dx) + \
-                         (y - player.y + dy) * (y - player.y + dy)
-                if r < SQUARED_TORCH_RADIUS:
-                    l = (SQUARED_TORCH_RADIUS - r) / SQUARED_TORCH_RADIUS + di
-                    if l < 0.0:
-                        l = 0.0
-                    elif l > 1.0:
-                        l = 1.0
-                    # alter base colors to simulate flickering torch
-                    base = libtcod.color_lerp(base, light, l)
-                # actually draw the visible tile
-                libtcod.console_set_char_background(con, x, y, base,
-                                                    libtcod.BKGND_SET)
-                #since it's visible, it's explored
-                map[x, y].explored = True
-
-    # Draw all objects in the list
-    for object in objects:
-        if object != player:
-            object.draw()
-    player.draw()
+    render_map(fov_mask, dx, dy, di)
+    with profiler.timer('render_objects'):
+        render_objects(fov_mask)
 
     # Blit the contents of con to the root console
     libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
 
+    render_panel()
+
+    # Blit the contents of "panel" to the root console
+    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0,
+                         PANEL_Y)
+
+
+def mark_all_dirty():
+    # Forget what was drawn to con and panel, so the next frame redraws
+    # everything (e.g. after con was cleared for a new level)
+    global con_background, con_glyphs, panel_contents
+    con_background = None
+    con_glyphs = {}
+    panel_contents = None
+
+
+def update_light_palette():
+    # (Re)build light_palette if the base colors changed: for the ground
+    # (index 0) and walls (index 1), the color of each light level, from the
+    # dark color at level 0 to the lit color at LIGHT_LEVELS - 1
+    global light_palette, light_palette_colors
+    colors = tuple(tuple(color) for color in (color_dark_ground,
+                                              color_light_ground,
+                                              color_dark_wall,
+                                              color_light_wall))
+    if colors == light_palette_colors:
+        return
+    levels = [level / (LIGHT_LEVELS - 1) for level in range(LIGHT_LEVELS)]
+    light_palette = np.array(
+        [[tuple(libtcod.color_lerp(dark, light, level)) for level in levels]
+         for (dark, light) in ((color_dark_ground, color_light_ground),
+                               (color_dark_wall, color_light_wall))],
+        dtype=np.uint8)
+    light_palette_colors = colors
+
+
+def render_map(visible, dx, dy, di):
+    # Compute the background color of every map tile at once and send the
+    # tiles that changed since the last frame to con. visible is the FOV as
+    # a boolean array, (dx, dy) the torch offset and di its intensity flicker
+    global con_background
+
+    update_light_palette()
+
+    # Let the torch actually flicker
+    tx = np.arange(map.width)[:, np.newaxis] - player.x + dx
+    ty = np.arange(map.height)[np.newaxis, :] - player.y + dy
+    r = tx * tx + ty * ty
+    l = np.clip((SQUARED_TORCH_RADIUS - r) / SQUARED_TORCH_RADIUS + di,
+                0.0, 1.0)
+    lit = visible & (r < SQUARED_TORCH_RADIUS)
+
+    # Visible tiles inside the torch radius get the flickering light, all
+    # other visible or explored tiles their dark color (light level 0)
+    level = np.where(lit, np.rint(l * (LIGHT_LEVELS - 1)).astype(np.intp), 0)
+    background = light_palette[map.block_sight.astype(np.intp), level]
+
+    # Since it's visible, it's explored. Tiles that were never explored
+    # stay black
+    map.explored |= visible
+    background[~map.explored] = 0
+
+    # Only send the tiles whose color changed (torch flicker, FOV changes,
+    # newly explored tiles). If there are many, one bulk fill is cheaper
+    if con_background is None:
+        changed = None
+    else:
+        changed = np.argwhere((background != con_background).any(axis=2))
+    if changed is None or len(changed) > DIRTY_FILL_LIMIT:
+        libtcod.console_fill_background(con, background[..., 0].T.ravel(),
+                                        background[..., 1].T.ravel(),
+                                        background[..., 2].T.ravel())
+    else:
+        for (x, y) in changed.tolist():
+            libtcod.console_set_char_background(
+                con, x, y, libtcod.Color(*background[x, y].tolist()),
+                libtcod.BKGND_SET)
+    con_background = background
+
+
+def render_objects(visible):
+    # Draw the objects that can be seen, erasing the ones that moved away or
+    # vanished. Only the tiles whose character or color changed are redrawn
+    global con_glyphs
+
+    glyphs = {}
+    for object in objects:
+        if object != player:
+            glyph_of(object, visible, glyphs)
+    glyph_of(player, visible, glyphs)  # The player is always drawn on top
+
+    for (x, y) in con_glyphs:
+        if (x, y) not in glyphs:
+            libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+    for ((x, y), glyph) in glyphs.items():
+        if con_glyphs.get((x, y)) != glyph:
+            (char, r, g, b) = glyph
+            libtcod.console_put_char(con, x, y, char, libtcod.BKGND_NONE)
+            libtcod.console_set_char_foreground(con, x, y,
+                                                libtcod.Color(r, g, b))
+    con_glyphs = glyphs
+
+
+def glyph_of(object, visible, glyphs):
+    # Record the character and color of an object in glyphs, if it is in
+    # FOV (or always visible and explored)
+    (x, y) = (object.x, object.y)
+    if visible[x, y] or (object.always_visible and map.explored[x, y]):
+        color = object.color
+        glyphs[(x, y)] = (object.char, color.r, color.g, color.b)
+
+
+def render_panel():
+    # Redraw the GUI panel, if anything shown on it changed
+    global panel_contents
+
+    names = get_names_under_mouse()
+    overlay = profiler.overlay_lines() if profiler.overlay else None
+    contents = ([(line, color.r, color.g, color.b)
+                 for (line, color) in game_msgs],
+                player.fighter.hp, player.fighter.max_hp, dungeon_level, names,
+                overlay)
+    if contents == panel_contents:
+        return
+    panel_contents = contents
+
     # Prepare to render the GUI panel
     libtcod.console_set_default_background(panel, libtcod.black)
     libtcod.console_clear(panel)
 
-    # Print the game messages
+    # Print the game messages, or the profiler overlay in their place
     y = 1
-    for (line, color) in game_msgs:
-        libtcod.console_set_default_foreground(panel, color)
+    if overlay is not None:
+        libtcod.console_set_default_foreground(panel, libtcod.light_grey)
         libtcod.console_set_alignment(panel, libtcod.LEFT)
-        libtcod.console_print(panel, MSG_X, y, line)
-        y += 1
+        for line in overlay[:MSG_HEIGHT]:
+            libtcod.console_print(panel, MSG_X, y, line)
+            y += 1
+    else:
+        for (line, color) in game_msgs:
+            libtcod.console_set_default_foreground(panel, color)
+            libtcod.console_set_alignment(panel, libtcod.LEFT)
+            libtcod.console_print(panel, MSG_X, y, line)
+            y += 1
 
     # Show the player's stats
     render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp,
@@ -805,11 +1686,7 @@ def render_all():
 
     # Display names of objects under the mouse
     libtcod.console_set_default_foreground(panel, libtcod.light_grey)
-    libtcod.console_print(panel, 1, 0, get_names_under_mouse())
-
-    # Blit the contents of "panel" to the root console
-    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0,
-                         PANEL_Y)
+    libtcod.console_print(panel, 1, 0, names)
 
 
 def menu(header, options, width):
@@ -818,6 +1695,8 @@ def menu(header, options, width):
 
     if len(options) > 26:
         raise ValueError('Cannot have a menu with more than 26 options!')
+    if headless:
+        return commands.choose(len(options))
     # Calculate total height for the header (after auto-wrap)
     # and one line per option
     header_height = libtcod.console_get_height_rect(con, 0, 0, width,
@@ -930,71 +1809,74 @@ def get_names_under_mouse():
 
     # Create a list with the names of all objects at the mouse's
     # coordinates and in FOV
-    names = [obj.name for obj in objects
-             if (obj.x == x and
-                 obj.y == y and
-                 libtcod.map_is_in_fov(fov_map, obj.x, obj.y))]
+    names = [obj.name for obj in object_index.at(x, y)
+             if fov_mask[obj.x, obj.y]]
 
     names = ', '.join(names)  # join the names, separated by commas
     return names.capitalize()
 
 
-def handle_keys():
-    global fov_recompute
-
+def read_command(wait=False):
+    # Return the player's command for this frame, or None: a key from MOVE_KEYS
+    # gives its MOVE_COMMANDS name, any other key its character. With wait,
+    # block until a key is pressed. In headless mode the command comes from
+    # the scripted commands instead
     global key
     global mouse
 
-    libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS, key, mouse)
+    if headless:
+        return commands.next_command()
+
+    if wait:
+        libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS, key, mouse, False)
+    else:
+        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS, key, mouse)
 
     if key.vk == libtcod.KEY_ENTER and key.lalt:
+        return 'fullscreen'
+    elif key.vk == libtcod.KEY_ESCAPE:
+        return 'exit'
+    for (move_key, command) in MOVE_KEYS:
+        if libtcod.console_is_key_pressed(move_key):
+            return command
+    if key.c:
+        return chr(key.c)
+    return None
+
+
+def handle_keys(wait=False):
+    global fov_recompute
+
+    command = read_command(wait)
+
+    if command == 'fullscreen':
         # Alt+Enter: Fullscreen
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
         return
-    elif key.vk == libtcod.KEY_ESCAPE:
+    elif command == 'exit':
         return 'exit'  # exit game
+    elif command == PROFILE_KEY:
+        # Show or hide the frame timings
+        profiler.overlay = not profiler.overlay
+        return
 
     if game_state == 'playing':
-        if player.wait > 0:  # Don't take a turn yet if still waiting
-            player.wait -= 1
+        if not scheduler.is_ready(player):  # Still waiting after the last turn
             return
-        if libtcod.console_is_key_pressed(libtcod.KEY_UP):
-            player_move_or_attack(0, -1)
-            fov_recompute = True
-        elif libtcod.console_is_key_pressed(libtcod.KEY_DOWN):
-            player_move_or_attack(0, 1)
-            fov_recompute = True
-        elif libtcod.console_is_key_pressed(libtcod.KEY_LEFT):
-            player_move_or_attack(-1, 0)
-            fov_recompute = True
-        elif libtcod.console_is_key_pressed(libtcod.KEY_RIGHT):
-            player_move_or_attack(1, 0)
-            fov_recompute = True
-        # Diagonal movement using the numpad keys
-        elif libtcod.console_is_key_pressed(libtcod.KEY_KP7):
-            player_move_or_attack(-1, -1)
-            fov_recompute = True
-        elif libtcod.console_is_key_pressed(libtcod.KEY_KP9):
-            player_move_or_attack(1, -1)
-            fov_recompute = True
-        elif libtcod.console_is_key_pressed(libtcod.KEY_KP1):
-            player_move_or_attack(-1, 1)
-            fov_recompute = True
-        elif libtcod.console_is_key_pressed(libtcod.KEY_KP3):
-            player_move_or_attack(1, 1)
+        if command in MOVE_COMMANDS:
+            (dx, dy) = MOVE_COMMANDS[command]
+            player_move_or_attack(dx, dy)
             fov_recompute = True
         else:
-            key_char = chr(key.c)
+            key_char = command
 
             if key_char == 'g':
                 # Pick up an item
-                for object in objects:  # Look for an item in the player's tile
-                    if (
-                        object.x == player.x and object.y == player.y and
-                        object.item
-                    ):
-                            object.item.pick_up()
-                            break
+                # Look for an item in the player's tile
+                for object in object_index.at(player.x, player.y):
+                    if object.item:
+                        object.item.pick_up()
+                        break
             if key_char == 'i':
                 # Show the inventory
                 chosen_item = inventory_menu('Press the key next to an \
@@ -1013,6 +1895,11 @@ def handle_keys():
                 # Go down stairs, if the player is on them
                 if stairs.x == player.x and stairs.y == player.y:
                     next_level()
+            if key_char == '>':
+                # Go up stairs, if the player is on them
+                if (upstairs is not None and
+                   upstairs.x == player.x and upstairs.y == player.y):
+                    previous_level()
             if key_char == 'c':
                 # Show character information
                 level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
@@ -1031,7 +1918,7 @@ def handle_keys():
 
 
 def player_move_or_attack(dx, dy):
-    global fov_recompute
+    global fov_recompute, player_turns
 
     # The coordinated the player is moving to
     x = player.x + dx
@@ -1039,8 +1926,8 @@ def player_move_or_attack(dx, dy):
 
     # Try to find an attackable object there
     target = None
-    for object in objects:
-        if object.fighter and object.x == x and object.y == y:
+    for object in object_index.at(x, y):
+        if object.fighter:
             target = object
             break
 
@@ -1050,6 +1937,23 @@ def player_move_or_attack(dx, dy):
     else:
         player.move(dx, dy)
         fov_recompute = True
+    end_turn(player)
+    player_turns += 1
+
+
+def end_turn(actor):
+    # Schedule the next turn of an actor for when the wait set by its last
+    # action (moving or attacking) is over
+    scheduler.schedule(actor, actor.wait + 1)
+    actor.wait = 0
+
+
+def schedule_actors():
+    # Start a new scheduler with every actor on the map ready to act
+    global scheduler
+    scheduler = Scheduler()
+    for object in registry.actors:
+        scheduler.schedule(object)
 
 
 def check_level_up():
@@ -1084,24 +1988,48 @@ def check_level_up():
 
 
 def initialize_fov():
-    global fov_recompute, fov_map, fov_noise
+    global fov_recompute, fov_map, fov_noise, fov_mask
     fov_recompute = True
 
-    libtcod.console_clear(con)  # Unexplored areas start black (which
-                                # is the default background color)
+    if not headless:
+        libtcod.console_clear(con)  # Unexplored areas start black (which
+                                    # is the default background color)
+        mark_all_dirty()
 
     #create the FOV map, according to the generated map
-    fov_noise = libtcod.noise_new(1, 1.0, 1.0)
-    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y,
-                                       not map[x, y].block_sight,
-                                       not map[x, y].blocked)
+    fov_noise = libtcod.noise_new(1, 1.0, 1.0, rng['fx'])
+    fov_mask = np.zeros(map.shape, dtype=np.bool_)
+    if FOV_ENGINE == 'libtcod':
+        fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+        libtcod.map_set_properties_array(fov_map, ~map.block_sight,
+                                         ~map.blocked)
+    else:
+        fov_map = None
+
+
+def recompute_fov():
+    # Compute the player's FOV into fov_mask
+    global fov_recompute, fov_mask
+    fov_recompute = False
+    if FOV_ENGINE == 'libtcod':
+        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS,
+                                FOV_LIGHT_WALLS, FOV_ALGO)
+        fov_mask = libtcod.map_get_fov_array(fov_map)
+    else:
+        fov_mask = compute_fov(~map.block_sight, player.x, player.y,
+                               TORCH_RADIUS, FOV_LIGHT_WALLS)
+    # The parked monsters the player can see now wake up
+    scheduler.wake(lambda monster: fov_mask[monster.x, monster.y])
+
+
+def in_fov(x, y):
+    # Whether a tile is in the player's FOV. Tiles outside the map never are
+    return 0 <= x < map.width and 0 <= y < map.height and bool(fov_mask[x, y])
 
 
 def new_game():
     global player, inventory, game_msgs, game_state, key, mouse, dungeon_level
+    global levels, game_seed
 
     # Create object representing the player
     fighter_component = Fighter(hp=100, defense=1, power=4, xp=0,
@@ -1110,10 +2038,20 @@ def new_game():
                     fighter=fighter_component, speed=PLAYER_SPEED)
 
     player.level = 1
-    # Generate map
+    # Generate map, forgetting the levels of any previous game
+    clear_levels()
+    levels = LevelCache(LEVEL_CACHE_SIZE, LEVEL_DIR)
+    if prefetcher is not None:
+        prefetcher.cancel()
+    if requested_seed is None:
+        game_seed = libtcod.random_get_int(0, 0, 0x7fffffff)
+    else:
+        game_seed = requested_seed & 0xffffffff
+    seed_streams(game_seed, game_streams())
     dungeon_level = 1
     make_map()
     initialize_fov()
+    prefetch_next_level()
 
     game_state = 'playing'
     inventory = []
@@ -1126,71 +2064,671 @@ def new_game():
              Tombs of the Ancient Kings.', libtcod.red)
 
 
-def play_game():
+def play_game(max_frames=None):
+    # Run the game loop, for at most max_frames frames if given. Returns the
+    # number of frames played
     player_action = None
+    frames = 0
+    next_flicker = 0.0  # When the screen is drawn next while idle
+    mouse_cell = None  # Where the mouse was, for the names under it
 
-    while not libtcod.console_is_window_closed():
-        # Render the screen
-        render_all()
+    while headless or not libtcod.console_is_window_closed():
+        if max_frames is not None and frames >= max_frames:
+            break
+        frames += 1
+
+        # While only the player can make something happen, only draw at the
+        # flicker rate, or wait for input without drawing anything new
+        idle = not headless and is_idle()
+        draw = True
+        if idle and IDLE_FLICKER_FPS:
+            now = time.perf_counter()
+            draw = now >= next_flicker
+            if draw:
+                next_flicker = now + 1.0 / IDLE_FLICKER_FPS
+        else:
+            next_flicker = 0.0
 
-        libtcod.console_flush()
-        check_level_up()
+        if headless:
+            # Nothing to draw, but the monsters still need the player's FOV
+            if fov_recompute:
+                recompute_fov()
+        else:
+            # Render the screen
+            if draw:
+                with profiler.timer('render_all'):
+                    render_all()
 
-        # Erease all objects at their old locations, befor they move
-        for object in objects:
-            object.clear()
+            with profiler.timer('console_flush'):
+                libtcod.console_flush()
+        with profiler.timer('check_level_up'):
+            check_level_up()
 
         # Handle keys and exit if needed
-        player_action = handle_keys()
+        with profiler.timer('handle_keys'):
+            player_action = handle_keys(idle and not IDLE_FLICKER_FPS)
+        # Show what the input did on the next frame even while idle: not all
+        # commands take a turn (items, menus, the profiler overlay)
+        if key.vk != libtcod.KEY_NONE or (mouse.cx, mouse.cy) != mouse_cell:
+            next_flicker = 0.0
+            mouse_cell = (mouse.cx, mouse.cy)
         if player_action == 'exit':
-            save_game()  # Save the current game before exit
+            if not headless:
+                save_game()  # Save the current game before exit
             break
 
-        # Let the monsters take their turn
+        # Let the monsters that are due take their turn
         if game_state == 'playing':
-            for object in objects:
-                if object.ai:
-                    # Don't take a turn yet if still waiting
-                    if object.wait > 0:
-                        object.wait -= 1
-                    else:
-                        object.ai.take_turn()
+            with profiler.timer('ai'):
+                take_monster_turns(scheduler.pop_due())
+        elif headless:
+            break  # Nobody is watching the corpse
+
+        if (AUTOSAVE_TURNS and not headless and
+           player_turns - last_autosave >= AUTOSAVE_TURNS):
+            autosave()
+        if autosaver is not None:
+            report_autosave_error()
+
+        scheduler.tick()
+        profiler.end_frame()
+
+    return frames
+
+
+def is_idle():
+    # Whether nothing can happen before the player acts: the player may act
+    # and no other actor has a turn coming (or the game is over)
+    if game_state != 'playing':
+        return True
+    return scheduler.is_ready(player) and not scheduler.has_turns(player)
+
+
+def run_headless(script, max_frames=None, default_choice=0):
+    # Play a new game without a window and without a frame rate limit,
+    # taking input from script (see ScriptedCommands). Returns the number of
+    # frames played
+    global headless, commands
+    headless = True
+    commands = ScriptedCommands(script, default_choice)
+    new_game()
+    return play_game(max_frames)
+
+
+def read_script(filename):
+    # Read a script for a headless run: one command per line, a number for a
+    # menu choice or "x,y" for a target tile. Empty lines are frames without
+    # input; everything after a # is ignored
+    script = []
+    with open(filename) as file:
+        for line in file:
+            line = line.split('#')[0].strip()
+            if not line:
+                script.append(None)
+            elif line.isdigit():
+                script.append(int(line))
+            elif ',' in line:
+                (x, y) = line.split(',')
+                script.append((int(x), int(y)))
+            else:
+                script.append(line)
+    return script
+
+
+def random_walk():
+    # Endless script that wanders around, picks up items and takes the
+    # stairs whenever possible
+    moves = list(MOVE_COMMANDS)
+    walk_rng = libtcod.random_new_from_seed(game_seed)
+    while True:
+        yield moves[libtcod.random_get_int(walk_rng, 0, len(moves) - 1)]
+        yield 'g'
+        yield '<'
+
+
+##############################
+# Saved games
+##############################
+
+# A saved game starts with a header, followed by the tile layers (bit
+# packed), the objects on the map, the inventory and the messages. Colors
+# are stored as RGB triples, functions and AIs by their index below
+SAVE_FILE = 'savegame.lot'
+SAVE_MAGIC = b'LoTs'
+SAVE_VERSION = 5
+LEVEL_MAGIC = b'LoTl'
+
+# magic, version, map width and height, dungeon level, seed of the game,
+# game state, index of the player, the stairs and the stairs up (-1: none)
+# in the objects, number of objects, inventory items, messages and levels
+# left
+GAME_HEADER = struct.Struct('<4sHHHhIBiiiIIHH')
+# magic, version, map width and height, dungeon level, index of the stairs
+# and the stairs up (-1: none) in the objects, number of objects
+LEVEL_HEADER = struct.Struct('<4sHHHhiiI')
+# x, y, character, flags, color, speed, wait, level, AI, turns left and
+# previous AI of a confused monster
+ENTITY_RECORD = struct.Struct('<hhIB3BhhhBhB')
+# max. hp, hp, defense, power, xp, death function, attack speed
+FIGHTER_RECORD = struct.Struct('<iiiiiBh')
+# use function
+ITEM_RECORD = struct.Struct('<B')
+TEXT_LENGTH = struct.Struct('<H')
+COLOR_RECORD = struct.Struct('<3B')
+# dungeon level, size of the level (see encode_level) that follows
+LEVEL_RECORD = struct.Struct('<hI')
+
+# Entity flags
+BLOCKS = 1
+ALWAYS_VISIBLE = 2
+CHAR_IS_BYTES = 4
+HAS_FIGHTER = 8
+HAS_ITEM = 16
+
+GAME_STATES = ['playing', 'dead']
+AI_CLASSES = [None, BasicMonster, ConfusedMonster]
+DEATH_FUNCTIONS = [None, player_death, monster_death]
+USE_FUNCTIONS = [None, cast_heal, cast_lightning, cast_fireball, cast_confuse]
+
+
+def ai_kind(ai):
+    # The index of an AI's class in AI_CLASSES
+    return AI_CLASSES.index(type(ai) if ai is not None else None)
+
+
+def entity_record(object):
+    # The state of an object as a tuple of plain values, which is all that
+    # pack_entities needs
+    ai = object.ai
+    (turns, old_ai) = (0, 0)
+    if isinstance(ai, ConfusedMonster):
+        (turns, old_ai) = (ai.num_turns, ai_kind(ai.old_ai))
+    flags = ((BLOCKS if object.blocks else 0) |
+             (ALWAYS_VISIBLE if object.always_visible else 0) |
+             (CHAR_IS_BYTES if isinstance(object.char, bytes) else 0))
+    fighter = None
+    if object.fighter:
+        f = object.fighter
+        fighter = (f.max_hp, f.hp, f.defense, f.power, f.xp,
+                   DEATH_FUNCTIONS.index(f.death_function), f.attack_speed)
+        flags |= HAS_FIGHTER
+    use = None
+    if object.item:
+        use = USE_FUNCTIONS.index(object.item.use_function)
+        flags |= HAS_ITEM
+    color = object.color
+    level = object.level if object.level is not None else -1
+    return ((object.x, object.y, ord(object.char), flags,
+             color.r, color.g, color.b, object.speed, object.wait, level,
+             ai_kind(ai), turns, old_ai), fighter, use, object.name)
+
+
+def pack_text(text):
+    data = text.encode('utf-8')
+    return TEXT_LENGTH.pack(len(data)) + data
+
+
+def unpack_text(data, offset):
+    (length,) = TEXT_LENGTH.unpack_from(data, offset)
+    offset += TEXT_LENGTH.size
+    return (data[offset:offset + length].decode('utf-8'), offset + length)
+
+
+def pack_entities(records):
+    # Pack entity_record tuples
+    parts = []
+    for (fields, fighter, use, name) in records:
+        parts.append(ENTITY_RECORD.pack(*fields))
+        if fighter is not None:
+            parts.append(FIGHTER_RECORD.pack(*fighter))
+        if use is not None:
+            parts.append(ITEM_RECORD.pack(use))
+        parts.append(pack_text(name))
+    return b''.join(parts)
+
+
+def unpack_entities(data, offset, count):
+    # Recreate count objects packed by pack_entities
+    entities = []
+    for i in range(count):
+        (x, y, char, flags, r, g, b, speed, wait, level,
+         ai, turns, old_ai) = ENTITY_RECORD.unpack_from(data, offset)
+        offset += ENTITY_RECORD.size
+
+        fighter = None
+        if flags & HAS_FIGHTER:
+            (max_hp, hp, defense, power, xp, death,
+             attack_speed) = FIGHTER_RECORD.unpack_from(data, offset)
+            offset += FIGHTER_RECORD.size
+            fighter = Fighter(max_hp, defense, power, xp,
+                              DEATH_FUNCTIONS[death], attack_speed)
+            fighter.hp = hp
+        item = None
+        if flags & HAS_ITEM:
+            (use,) = ITEM_RECORD.unpack_from(data, offset)
+            offset += ITEM_RECORD.size
+            item = Item(USE_FUNCTIONS[use])
+        (name, offset) = unpack_text(data, offset)
+
+        ai_component = None
+        if AI_CLASSES[ai] is ConfusedMonster:
+            ai_component = ConfusedMonster(AI_CLASSES[old_ai](), turns)
+        elif AI_CLASSES[ai] is not None:
+            ai_component = AI_CLASSES[ai]()
+
+        char = bytes([char]) if flags & CHAR_IS_BYTES else chr(char)
+        object = Object(x, y, char, name, libtcod.Color(r, g, b),
+                        blocks=bool(flags & BLOCKS),
+                        always_visible=bool(flags & ALWAYS_VISIBLE),
+                        fighter=fighter, ai=ai_component, item=item,
+                        speed=speed)
+        if isinstance(ai_component, ConfusedMonster):
+            ai_component.old_ai.owner = object
+        object.wait = wait
+        object.level = level if level >= 0 else None
+        entities.append(object)
+    return (entities, offset)
+
+
+def tile_layers(tiles):
+    return (tiles.blocked, tiles.block_sight, tiles.explored)
+
+
+def pack_tiles(layers):
+    # The tile layers, eight tiles to a byte
+    return b''.join(np.packbits(layer).tobytes() for layer in layers)
+
+
+def unpack_tiles(data, offset, width, height):
+    tiles = TileMap(width, height)
+    size = (width * height + 7) // 8
+    for name in ('blocked', 'block_sight', 'explored'):
+        bits = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+        layer = np.unpackbits(bits, count=width * height).astype(np.bool_)
+        setattr(tiles, name, layer.reshape(width, height))
+        offset += size
+    return (tiles, offset)
+
+
+def message_records(messages):
+    # The messages as (line, (r, g, b)) tuples
+    return [(line, (color.r, color.g, color.b)) for (line, color) in messages]
+
+
+def pack_messages(records):
+    return b''.join(pack_text(line) + COLOR_RECORD.pack(*rgb)
+                    for (line, rgb) in records)
+
+
+def unpack_messages(data, offset, count):
+    messages = []
+    for i in range(count):
+        (line, offset) = unpack_text(data, offset)
+        color = libtcod.Color(*COLOR_RECORD.unpack_from(data, offset))
+        offset += COLOR_RECORD.size
+        messages.append((line, color))
+    return (messages, offset)
+
+
+def snapshot_game():
+    # Copy the game state into plain values that encode_snapshot can turn
+    # into a saved game later, even while the game goes on
+    header = (SAVE_MAGIC, SAVE_VERSION, map.width, map.height, dungeon_level,
+              game_seed, GAME_STATES.index(game_state), objects.index(player),
+              objects.index(stairs), index_of(upstairs, objects),
+              len(objects), len(inventory), len(game_msgs))
+    level_records = levels.saved_levels()
+    return (header + (len(level_records),),
+            [layer.copy() for layer in tile_layers(map)],
+            [entity_record(o) for o in objects],
+            [entity_record(o) for o in inventory],
+            message_records(game_msgs), level_records)
+
+
+def encode_snapshot(snapshot):
+    # The bytes of a saved game from a snapshot_game snapshot
+    (header, layers, object_records, item_records, messages,
+     level_records) = snapshot
+    return b''.join([GAME_HEADER.pack(*header), pack_tiles(layers),
+                     pack_entities(object_records),
+                     pack_entities(item_records), pack_messages(messages),
+                     pack_levels(level_records)])
+
+
+def pack_levels(records):
+    # Pack the levels from LevelCache.saved_levels: snapshots of the levels
+    # in memory, and the files of the spilled ones
+    parts = []
+    for (number, level) in records:
+        if isinstance(level, str):
+            with open(level, 'rb') as file:
+                data = file.read()
+        else:
+            data = encode_level_snapshot(level)
+        parts.append(LEVEL_RECORD.pack(number, len(data)) + data)
+    return b''.join(parts)
+
+
+def unpack_levels(data, offset, count):
+    records = []
+    for i in range(count):
+        (number, size) = LEVEL_RECORD.unpack_from(data, offset)
+        offset += LEVEL_RECORD.size
+        records.append((number, data[offset:offset + size]))
+        offset += size
+    return (records, offset)
+
+
+def index_of(object, objects):
+    # Index of an optional object in a list, -1 for None
+    return objects.index(object) if object is not None else -1
+
+
+def check_header(magic, version, expected_magic):
+    if magic != expected_magic:
+        raise ValueError('Not a saved game')
+    if version != SAVE_VERSION:
+        raise ValueError('Unsupported save version {}'.format(version))
+
+
+def decode_game(data):
+    # Restore the game from the bytes of a saved game. Returns the levels the
+    # player left, for LevelCache.restore
+    global map, objects, player, inventory, game_msgs
+    global game_state, stairs, upstairs, dungeon_level, game_seed
+
+    (magic, version, width, height, level, seed, state, player_index,
+     stairs_index, upstairs_index, num_objects, num_items,
+     num_messages, num_levels) = GAME_HEADER.unpack_from(data, 0)
+    check_header(magic, version, SAVE_MAGIC)
+
+    offset = GAME_HEADER.size
+    (map, offset) = unpack_tiles(data, offset, width, height)
+    (objects, offset) = unpack_entities(data, offset, num_objects)
+    (inventory, offset) = unpack_entities(data, offset, num_items)
+    (game_msgs, offset) = unpack_messages(data, offset, num_messages)
+    (level_records, offset) = unpack_levels(data, offset, num_levels)
+    player = objects[player_index]
+    stairs = objects[stairs_index]
+    upstairs = objects[upstairs_index] if upstairs_index >= 0 else None
+    game_state = GAME_STATES[state]
+    dungeon_level = level
+    game_seed = seed
+    return level_records
+
+
+def snapshot_level(number, level):
+    # Copy dungeon level number, as kept by LevelCache, into plain values,
+    # like snapshot_game
+    (tiles, level_objects, level_stairs, level_upstairs) = level
+    header = (LEVEL_MAGIC, SAVE_VERSION, tiles.width, tiles.height, number,
+              level_objects.index(level_stairs),
+              index_of(level_upstairs, level_objects), len(level_objects))
+    return (header, [layer.copy() for layer in tile_layers(tiles)],
+            [entity_record(o) for o in level_objects])
+
+
+def encode_level_snapshot(snapshot):
+    # The bytes of a level from a snapshot_level snapshot
+    (header, layers, records) = snapshot
+    return b''.join([LEVEL_HEADER.pack(*header), pack_tiles(layers),
+                     pack_entities(records)])
+
+
+def encode_level(number, level):
+    # The bytes of dungeon level number, as kept by LevelCache
+    return encode_level_snapshot(snapshot_level(number, level))
+
+
+def decode_level(data, expected_number):
+    # The level from the bytes of dungeon level expected_number
+    (magic, version, width, height, number, stairs_index, upstairs_index,
+     num_objects) = LEVEL_HEADER.unpack_from(data, 0)
+    check_header(magic, version, LEVEL_MAGIC)
+    if number != expected_number:
+        raise ValueError('Level {} found instead of level {}'.format(
+            number, expected_number))
+    offset = LEVEL_HEADER.size
+    (tiles, offset) = unpack_tiles(data, offset, width, height)
+    (level_objects, offset) = unpack_entities(data, offset, num_objects)
+    level_upstairs = None
+    if upstairs_index >= 0:
+        level_upstairs = level_objects[upstairs_index]
+    return (tiles, level_objects, level_objects[stairs_index], level_upstairs)
+
+
+class LevelCache:
+  # The levels the player left, by dungeon level, as (map, objects, stairs,
+  # upstairs) tuples. The most recently left ones stay in memory; beyond
+  # capacity, the least recently used are spilled to files in a directory of
+  # this game's own, which clear() removes. Saved games hold all the levels
+  # (see saved_levels), so the files never outlive the game
+
+    def __init__(self, capacity, parent=None):
+        self.capacity = capacity
+        self.parent = parent
+        self.directory = None  # Created when the first level is spilled
+        self.levels = collections.OrderedDict()
+        self.snapshots = {}  # snapshot_level of the levels in memory
+        self.spilled = {}  # Level number -> file name
+        self.spills = 0  # Numbers the files, which are never overwritten
+
+    def store(self, number, level):
+        self.levels[number] = level
+        self.levels.move_to_end(number)
+        self.snapshots[number] = snapshot_level(number, level)
+        while len(self.levels) > self.capacity:
+            (number, level) = self.levels.popitem(last=False)
+            self.spill(number,
+                       encode_level_snapshot(self.snapshots.pop(number)))
+
+    def spill(self, number, data):
+        if self.directory is None:
+            if self.parent is not None:
+                os.makedirs(self.parent, exist_ok=True)
+            self.directory = tempfile.mkdtemp(prefix='lot-levels-',
+                                              dir=self.parent)
+        filename = os.path.join(self.directory, 'level{}-{}.lot'.format(
+            number, self.spills))
+        self.spills += 1
+        # A plain write: the file is new, and worthless after a crash
+        with open(filename, 'wb') as file:
+            file.write(data)
+        self.spilled[number] = filename
+
+    def __contains__(self, number):
+        return number in self.levels or number in self.spilled
+
+    def take(self, number):
+        # Remove a level from the cache and return it, or None if it was
+        # never stored. Its file stays until clear(), as an autosave may
+        # still be reading it
+        if number in self.levels:
+            del self.snapshots[number]
+            return self.levels.pop(number)
+        filename = self.spilled.pop(number, None)
+        if filename is None:
+            return None
+        with open(filename, 'rb') as file:
+            return decode_level(file.read(), number)
+
+    def saved_levels(self):
+        # Every level as (number, snapshot_level snapshot or file name), for
+        # snapshot_game. Only taking these is left to the game loop: the
+        # encoding and reading happen in pack_levels, on the Autosaver thread
+        # for autosaves
+        return ([(number, self.snapshots[number]) for number in self.levels] +
+                sorted(self.spilled.items()))
+
+    def restore(self, records):
+        # Take the levels of a saved game, as (number, bytes). They are only
+        # decoded when the player gets back to them
+        for (number, data) in records:
+            self.spill(number, data)
+
+    def clear(self):
+        # Forget all levels, removing the files
+        self.levels.clear()
+        self.snapshots.clear()
+        self.spilled.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class LevelPrefetcher:
+  # Generates levels ahead of time in worker processes. Levels are
+  # identified by the seed of the game and their number
+
+    def __init__(self, workers=1):
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        self.pending = {}
+
+    def request(self, seed, number):
+        # Start generating a level. Returns False if the pool is broken (a
+        # worker died), and no level can be prefetched any more
+        if (seed, number) not in self.pending:
+            try:
+                self.pending[(seed, number)] = self.executor.submit(
+                    generate_level, seed, number)
+            except concurrent.futures.BrokenExecutor:
+                return False
+        return True
+
+    def take(self, seed, number):
+        # The requested level and the index of the player in its objects (see
+        # generate_level), waiting for it if it is not ready yet. (None, None)
+        # if it was not requested or could not be generated
+        future = self.pending.pop((seed, number), None)
+        if future is None:
+            return (None, None)
+        try:
+            (player_index, data) = future.result()
+            return (decode_level(data, number), player_index)
+        except Exception:
+            return (None, None)
+
+    def cancel(self):
+        # Forget the levels requested so far
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    def shutdown(self):
+        self.pending.clear()
+        self.executor.shutdown(cancel_futures=True)
+
+
+def write_atomic(filename, data):
+    # Write a file so that it holds either the old or the new data, even if
+    # the game crashes halfway: write a temporary file, sync it to disk and
+    # rename it over the old one
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filename, filename)
+
+
+class Autosaver:
+  # Writes saved games on a worker thread, so the game loop only pays for
+  # taking a snapshot. If a snapshot is still waiting when the next one
+  # arrives, only the newer one gets written. A failed write is kept for the
+  # game loop to report (see take_error)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = None
+        self.busy = False
+        self.error = None  # The last error while writing, if any
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, snapshot):
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify_all()
+
+    def flush(self):
+        # Wait until every submitted snapshot has been written
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+
+    def take_error(self):
+        # The error of the last failed write not reported yet, or None
+        with self.condition:
+            (error, self.error) = (self.error, None)
+        return error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                (snapshot, self.pending) = (self.pending, None)
+                self.busy = True
+            try:
+                write_atomic(self.filename, encode_snapshot(snapshot))
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+
+def autosave():
+    # Save the game in the background
+    global autosaver, last_autosave
+    if autosaver is None:
+        autosaver = Autosaver(SAVE_FILE)
+    autosaver.submit(snapshot_game())
+    last_autosave = player_turns
+
+
+def report_autosave_error():
+    # Tell the player if the last autosave could not be written, since the
+    # progress since the one before would be lost
+    error = autosaver.take_error()
+    if error is not None:
+        message('Autosave failed: {}'.format(error), libtcod.red)
+
+
+def clear_levels():
+    # Remove the levels the player left in the game, once the autosave that
+    # may still be reading them is written
+    if autosaver is not None:
+        autosaver.flush()
+    if levels is not None:
+        levels.clear()
 
 
 def save_game():
-    # Open a new emtpy shelve (possibly overwriting an old one)
-    # to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    # Index of player in objects list
-    file['player_index'] = objects.index(player)
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)
-    file['dungeon_level'] = dungeon_level
-    file.close()
+    # Write the game data, overwriting an old saved game
+    if autosaver is not None:
+        autosaver.flush()  # Don't let an older autosave overwrite this one
+    write_atomic(SAVE_FILE, encode_snapshot(snapshot_game()))
 
 
 def load_game():
-    # Open the previously saved shelve and load the game data
-    global map, objects, player, inventory, game_msgs
-    global game_state, stairs, dungeon_level
-
-    file = shelve.open('savegame', 'r')
-    map = file['map']
-    objects = file['objects']
-    # Get the index of the player in objects list and access it
-    player = objects[file['player_index']]
-    inventory = file['inventory']
-    game_msgs = file['game_msgs']
-    game_state = file['game_state']
-    stairs = objects[file['stairs_index']]
-    dungeon_level = file['dungeon_level']
-    file.close()
+    # Load the previously saved game, with the levels the player left
+    global levels
+    with open(SAVE_FILE, 'rb') as file:
+        level_records = decode_game(file.read())
+    clear_levels()
+    levels = LevelCache(LEVEL_CACHE_SIZE, LEVEL_DIR)
+    levels.restore(level_records)
+    seed_streams(game_seed, game_streams())
+
+    index_objects()
+    schedule_actors()
 
     initialize_fov()
+    if prefetcher is not None:
+        prefetcher.cancel()
+    prefetch_next_level()
 
 
 def main_menu():
@@ -1228,21 +2766,88 @@ def main_menu():
             break
 
 
+def init_console():
+    # Open the game window and create the offscreen consoles
+    global con, panel
+    libtcod.console_set_custom_font(b'img/fonts/arial10x10.png',
+                                    (libtcod.FONT_TYPE_GREYSCALE |
+                                     libtcod.FONT_LAYOUT_TCOD))
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT,
+                              b'LoT - The Legend of Tharsa', False)
+    libtcod.sys_set_fps(LIMIT_FPS)
+
+    con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='The Legend of Tharsa')
+    parser.add_argument('--headless', action='store_true',
+                        help='simulate a game without a window')
+    parser.add_argument('--script',
+                        help='commands for a headless game, one per line '
+                             '(default: walk around randomly)')
+    parser.add_argument('--frames', type=int, default=HEADLESS_FRAMES,
+                        help='maximum length of a headless game in frames '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help='generate each level when the player gets there')
+    parser.add_argument('--seed', type=int,
+                        help='seed of new games, for reproducible runs '
+                             '(default: a random one)')
+    parser.add_argument('--profile-csv', metavar='FILE',
+                        help='write the timings of every frame to a CSV file')
+    parser.add_argument('--count-calls', action='store_true',
+                        help='count the calls into libtcod and print the most '
+                             'expensive ones at exit')
+    args = parser.parse_args()
+
+    global prefetcher, requested_seed
+    requested_seed = args.seed
+    if PREFETCH_LEVELS and not args.no_prefetch:
+        prefetcher = LevelPrefetcher()
+    if args.profile_csv:
+        profiler.open_csv(args.profile_csv)
+    if args.count_calls:
+        libtcod.enable_call_counting()
+
+    try:
+        if args.headless:
+            if args.script:
+                script = read_script(args.script)
+            else:
+                script = random_walk()
+            start = time.perf_counter()
+            frames = run_headless(script, args.frames)
+            elapsed = time.perf_counter() - start
+            rate = frames / max(elapsed, 1e-9)
+            print('{} frames in {:.2f} s ({:.0f} frames/s), dungeon level {}, '
+                  'player {}, seed {}'.format(frames, elapsed, rate,
+                                              dungeon_level, game_state,
+                                              game_seed))
+            return
+        init_console()
+        main_menu()
+    finally:
+        if prefetcher is not None:
+            prefetcher.shutdown()
+        clear_levels()
+        profiler.close()
+        if args.count_calls:
+            profiler.print_native_calls()
+
+
 ##############################
 # Initialization & Main Loop
 ##############################
 
-libtcod.console_set_custom_font(b'img/fonts/arial10x10.png',
-                                (libtcod.FONT_TYPE_GREYSCALE |
-                                 libtcod.FONT_LAYOUT_TCOD))
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT,
-                          b'LoT - The Legend of Tharsa', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+con = None
+panel = None
 
 key = libtcod.Key()
 mouse = libtcod.Mouse()
 
-main_menu()
+profiler = FrameProfiler(PROFILE_TIMERS)
+
+if __name__ == '__main__':
+    main()